@@ -16,6 +16,8 @@ import torch  # for experiment on asynchronous data
 
 import h5py
 
+from utils.sensors import get_sensor_specs
+
 
 class Replica(Dataset):
     def __init__(self, config_data):
@@ -51,6 +53,8 @@ class Replica(Dataset):
         self.min_depth = config_data.min_depth
         self.max_depth = config_data.max_depth
 
+        self.specs = get_sensor_specs(config_data)
+
         self.transform = config_data.transform
         self.pad = config_data.pad
 
@@ -255,12 +259,9 @@ class Replica(Dataset):
                     file = self.depth_images[sensor_][item]
                 depth = io.imread(file).astype(np.float32)
 
-                try:
-                    step_x = depth.shape[0] / eval("self.resolution_" + sensor_ + "[0]")
-                    step_y = depth.shape[1] / eval("self.resolution_" + sensor_ + "[1]")
-                except AttributeError:  # default values used in case sensor specific parameters do not exist
-                    step_x = depth.shape[0] / self.resolution[0]
-                    step_y = depth.shape[1] / self.resolution[1]
+                spec = self.specs[sensor_]
+                step_x = depth.shape[0] / spec.resolution[0]
+                step_y = depth.shape[1] / spec.resolution[1]
 
                 index_y = [
                     int(step_y * i) for i in range(0, int(depth.shape[1] / step_y))
@@ -329,28 +330,15 @@ class Replica(Dataset):
                     not self.filtering_model == "tsdf_early_fusion"
                     and not self.filtering_model == 2
                 ):
-                    try:
-                        mask = depth > eval("self.min_depth_" + sensor_)
-                        mask = np.logical_and(
-                            mask, depth < eval("self.max_depth_" + sensor_)
-                        )
+                    mask = depth > spec.min_depth
+                    mask = np.logical_and(mask, depth < spec.max_depth)
 
-                        # do not integrate depth values close to the image boundary
-                        mask[0 : eval("self.mask_" + sensor_ + "_height"), :] = 0
-                        mask[-eval("self.mask_" + sensor_ + "_height") : -1, :] = 0
-                        mask[:, 0 : eval("self.mask_" + sensor_ + "_width")] = 0
-                        mask[:, -eval("self.mask_" + sensor_ + "_width") : -1] = 0
-                        sample[sensor_ + "_mask"] = mask
-                    except AttributeError:
-                        mask = depth > self.min_depth
-                        mask = np.logical_and(mask, depth < self.max_depth)
-
-                        # do not integrate depth values close to the image boundary
-                        mask[0 : self.mask_height, :] = 0
-                        mask[-self.mask_height : -1, :] = 0
-                        mask[:, 0 : self.mask_width] = 0
-                        mask[:, -self.mask_width : -1] = 0
-                        sample[sensor_ + "_mask"] = mask
+                    # do not integrate depth values close to the image boundary
+                    mask[0 : spec.mask_height, :] = 0
+                    mask[-spec.mask_height : -1, :] = 0
+                    mask[:, 0 : spec.mask_width] = 0
+                    mask[:, -spec.mask_width : -1] = 0
+                    sample[sensor_ + "_mask"] = mask
 
         if self.filtering_model == "tsdf_early_fusion" or self.filtering_model == 2:
             mask_min = np.zeros_like(sample[self.input[0] + "_depth"])
@@ -418,31 +406,18 @@ class Replica(Dataset):
         sample["extrinsics"] = np.matmul(rot_90_around_x, extrinsics[0:3, 0:4])
 
         hfov = 90.0
-        try:
-            for sensor_ in self.input:
-                f = (
-                    eval("self.resolution_" + sensor_ + "[0]")
-                    / 2.0
-                    * (1.0 / np.tan(np.deg2rad(hfov) / 2))
-                )  # I always assume square input images
-                shift = eval("self.resolution_" + sensor_ + "[0]") / 2
-
-                # load intrinsics
-                intrinsics = np.asarray(
-                    [[f, 0.0, shift], [0.0, f, shift], [0.0, 0.0, 1.0]]
-                )
-
-                sample["intrinsics_" + sensor_] = intrinsics
-        except AttributeError:
+        for sensor_ in self.input:
             f = (
-                self.resolution[0] / 2.0 * (1.0 / np.tan(np.deg2rad(hfov) / 2))
+                self.specs[sensor_].resolution[0]
+                / 2.0
+                * (1.0 / np.tan(np.deg2rad(hfov) / 2))
             )  # I always assume square input images
-            shift = self.resolution[0] / 2
+            shift = self.specs[sensor_].resolution[0] / 2
 
             # load intrinsics
             intrinsics = np.asarray([[f, 0.0, shift], [0.0, f, shift], [0.0, 0.0, 1.0]])
 
-            sample["intrinsics"] = intrinsics
+            sample["intrinsics_" + sensor_] = intrinsics
 
         sample["frame_id"] = frame_id
 
@@ -495,25 +470,13 @@ class Replica(Dataset):
 
         intrinsics = dict()
         hfov = 90.0
-        try:
-            for sensor_ in self.input:
-                f = (
-                    eval("self.resolution_" + sensor_ + "[0]")
-                    / 2.0
-                    * (1.0 / np.tan(np.deg2rad(hfov) / 2))
-                )  # I always assume square input images
-                shift = eval("self.resolution_" + sensor_ + "[0]") / 2
-
-                # load intrinsics
-                intrinsics[sensor_] = np.asarray(
-                    [[f, 0.0, shift], [0.0, f, shift], [0.0, 0.0, 1.0]]
-                )
-
-        except AttributeError:
+        for sensor_ in self.input:
             f = (
-                self.resolution[0] / 2.0 * (1.0 / np.tan(np.deg2rad(hfov) / 2))
+                self.specs[sensor_].resolution[0]
+                / 2.0
+                * (1.0 / np.tan(np.deg2rad(hfov) / 2))
             )  # I always assume square input images
-            shift = self.resolution[0] / 2
+            shift = self.specs[sensor_].resolution[0] / 2
 
             # load intrinsics
             intrinsics[sensor_] = np.asarray(
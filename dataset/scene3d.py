@@ -13,6 +13,7 @@ from torch.utils.data import Dataset
 # import matplotlib.pyplot as plt
 from dataset.colmap import read_array
 import itertools
+from utils.sensors import get_sensor_specs
 
 import h5py
 
@@ -47,6 +48,8 @@ class Scene3D(Dataset):
         self.min_depth = config_data.min_depth
         self.max_depth = config_data.max_depth
 
+        self.specs = get_sensor_specs(config_data)
+
         self.transform = config_data.transform
         self.pad = config_data.pad
 
@@ -224,12 +227,9 @@ class Scene3D(Dataset):
             elif sensor_ == "stereo":
                 depth = read_array(file)
 
-            try:
-                step_x = depth.shape[0] / eval("self.resolution_" + sensor_ + "[0]")
-                step_y = depth.shape[1] / eval("self.resolution_" + sensor_ + "[1]")
-            except AttributeError:  # default values used in case sensor specific parameters do not exist
-                step_x = depth.shape[0] / self.resolution[0]
-                step_y = depth.shape[1] / self.resolution[1]
+            spec = self.specs[sensor_]
+            step_x = depth.shape[0] / spec.resolution[0]
+            step_y = depth.shape[1] / spec.resolution[1]
 
             index_y = [int(step_y * i) for i in range(0, int(depth.shape[1] / step_y))]
             index_x = [int(step_x * i) for i in range(0, int(depth.shape[0] / step_x))]
@@ -243,26 +243,15 @@ class Scene3D(Dataset):
             # plt.imsave(sensor_ + '_depth' +frame +'.png', sample[sensor_ + '_depth'])
 
             # define mask
-            try:
-                mask = depth > eval("self.min_depth_" + sensor_)
-                mask = np.logical_and(mask, depth < eval("self.max_depth_" + sensor_))
-
-                # do not integrate depth values close to the image boundary
-                mask[0 : eval("self.mask_" + sensor_ + "_height"), :] = 0
-                mask[-eval("self.mask_" + sensor_ + "_height") : -1, :] = 0
-                mask[:, 0 : eval("self.mask_" + sensor_ + "_width")] = 0
-                mask[:, -eval("self.mask_" + sensor_ + "_width") : -1] = 0
-                sample[sensor_ + "_mask"] = mask
-            except AttributeError:
-                mask = depth > self.min_depth
-                mask = np.logical_and(mask, depth < self.max_depth)
-
-                # do not integrate depth values close to the image boundary
-                mask[0 : self.mask_height, :] = 0
-                mask[-self.mask_height : -1, :] = 0
-                mask[:, 0 : self.mask_width] = 0
-                mask[:, -self.mask_width : -1] = 0
-                sample[sensor_ + "_mask"] = mask
+            mask = depth > spec.min_depth
+            mask = np.logical_and(mask, depth < spec.max_depth)
+
+            # do not integrate depth values close to the image boundary
+            mask[0 : spec.mask_height, :] = 0
+            mask[-spec.mask_height : -1, :] = 0
+            mask[:, 0 : spec.mask_width] = 0
+            mask[:, -spec.mask_width : -1] = 0
+            sample[sensor_ + "_mask"] = mask
 
         # load extrinsics
         extrinsics = self.cameras[scene + "/" + str(int(frame))]
@@ -1,10 +1,17 @@
 import os
 import h5py
+import math
+import tempfile
+import threading
+
+from collections.abc import Mapping
 
 import numpy as np
+import torch
 
 from torch.utils.data import Dataset
-from modules.voxelgrid import VoxelGrid, FeatureGrid
+from modules.voxelgrid import VoxelGrid, FeatureGrid, BlockGrid, to_numpy, unravel_index
+from modules.voxelgrid import occupancy, voxel_values
 
 from utils.metrics import evaluation
 
@@ -22,6 +29,22 @@ class Database(Dataset):
         self.test_mode = config.test_mode
         self.alpha_supervision = config.alpha_supervision
         self.outlier_channel = config.outlier_channel
+        # store the fused grids in sparse bricks of block_size^3 voxels
+        self.block_size = config.block_size if config.sparse_grid else None
+        # the fused grids are stored as float16 and updated in this precision
+        self.working_dtype = getattr(torch, config.working_dtype)
+        # the dense grids are memory mapped files in a scratch directory of the
+        # database, such that only the working set of the grids is held in RAM.
+        # The directory is removed with the database or at exit
+        if config.scratch_dir:
+            os.makedirs(config.scratch_dir, exist_ok=True)
+            self._scratch = tempfile.TemporaryDirectory(
+                prefix="database_", dir=config.scratch_dir
+            )
+            self.scratch_dir = self._scratch.name
+        else:
+            self._scratch = None
+            self.scratch_dir = None
 
         self.scenes_gt = {}
         self.tsdf = {}
@@ -34,6 +57,11 @@ class Database(Dataset):
             self.features[sensor_] = {}
 
         self.filtered = {}  # grid to store the fused sdf prediction
+        self.resident = {}  # fused grids kept on the compute device during fusion
+        # blocks of block_size^3 voxels updated since the last filtering pass
+        self.dirty = {}
+        self.dirty_block_size = config.block_size
+        self._dirty_lock = threading.Lock()  # the sensors may be fused concurrently
         if config.test_mode:
             self.sensor_weighting = {}
 
@@ -46,27 +74,37 @@ class Database(Dataset):
                 self.proxy_alpha[s] = dataset.get_proxy_alpha_grid(s)
             self.scenes_gt[s] = VoxelGrid(voxel_size, grid, bbox)
 
+            shape = self.scenes_gt[s].shape
             for sensor in config.input:
-                self.fusion_weights[sensor][s] = np.zeros(
-                    self.scenes_gt[s].shape, dtype=np.float16
+                self.fusion_weights[sensor][s] = self._empty_grid(
+                    shape, name=s + "_" + sensor + ".weights"
                 )
 
                 self.features[sensor][s] = FeatureGrid(
-                    voxel_size, self.n_features, bbox
+                    voxel_size,
+                    self.n_features,
+                    bbox,
+                    block_size=self.block_size,
+                    volume=self._empty_grid(
+                        tuple(shape) + (self.n_features,),
+                        name=s + "_" + sensor + ".features",
+                    ),
                 )
 
                 self.tsdf[sensor][s] = VoxelGrid(
                     voxel_size,
-                    volume=None,
+                    volume=self._empty_grid(
+                        shape, self.initial_value, name=s + "_" + sensor + ".tsdf"
+                    ),
                     bbox=bbox,
-                    initial_value=self.initial_value,
                 )
 
             self.filtered[s] = VoxelGrid(
                 voxel_size,
-                volume=None,
+                volume=self._dense_grid(
+                    shape, self.initial_value, name=s + ".tsdf_filtered"
+                ),
                 bbox=bbox,
-                initial_value=self.initial_value,
             )
             if config.test_mode:
                 if config.outlier_channel:
@@ -76,42 +114,213 @@ class Database(Dataset):
                         self.scenes_gt[s].shape[1],
                         self.scenes_gt[s].shape[2],
                     )
-                    self.sensor_weighting[s] = -np.ones(
-                        sensor_weighting_shape, dtype=np.float16
+                    self.sensor_weighting[s] = self._dense_grid(
+                        sensor_weighting_shape, -1.0, name=s + ".sensor_weighting"
                     )
                 else:
                     # initialize to negative so that we know what values are initialized without needing the mask later in the visualization script
-                    self.sensor_weighting[s] = -np.ones(
-                        self.scenes_gt[s].shape, dtype=np.float16
+                    self.sensor_weighting[s] = self._dense_grid(
+                        self.scenes_gt[s].shape, -1.0, name=s + ".sensor_weighting"
                     )
 
     def __getitem__(self, item):
+        return SceneView(self, item)
 
-        sample = dict()
-
-        sample["gt"] = self.scenes_gt[item].volume
+    def scene_keys(self, scene_id):
+        keys = ["gt", "origin", "resolution", "filtered"]
         if self.alpha_supervision:
-            sample["proxy_alpha"] = self.proxy_alpha[item]
-        sample["origin"] = self.scenes_gt[item].origin
-        sample["resolution"] = self.scenes_gt[item].resolution
-        sample["filtered"] = self.filtered[item].volume
+            keys.append("proxy_alpha")
         if self.test_mode:
-            sample["sensor_weighting"] = self.sensor_weighting[item]
+            keys.append("sensor_weighting")
         for sensor_ in self.sensors:
-            sample["tsdf_" + sensor_] = self.tsdf[sensor_][item].volume
-            sample["weights_" + sensor_] = self.fusion_weights[sensor_][item]
-            sample["features_" + sensor_] = self.features[sensor_][item].volume
+            keys += ["tsdf_" + sensor_, "weights_" + sensor_, "features_" + sensor_]
+        return keys
+
+    def get_value(self, scene_id, key):
+        """Returns the untransformed value of a single key of a scene."""
+        if key == "gt":
+            return self.scenes_gt[scene_id].volume
+        elif key == "origin":
+            return self.scenes_gt[scene_id].origin
+        elif key == "resolution":
+            return self.scenes_gt[scene_id].resolution
+        elif key == "filtered":
+            return self.filtered[scene_id].volume
+        elif key == "proxy_alpha" and self.alpha_supervision:
+            return self.proxy_alpha[scene_id]
+        elif key == "sensor_weighting" and self.test_mode:
+            return self.sensor_weighting[scene_id]
+
+        resident = self.resident.get(scene_id, {})
+        if key in resident:
+            return resident[key]
+        return self._get_grid(scene_id, key)
+
+    def _empty_grid(self, shape, initial_value=0.0, name=None):
+        if self.block_size:
+            return BlockGrid(shape, self.block_size, initial_value)
+        return self._dense_grid(shape, initial_value, name)
+
+    def _dense_grid(self, shape, initial_value=0.0, name=None):
+        """Returns a dense float16 grid, which is a memory mapped file named after
+        the grid when there is a scratch directory."""
+        if self.scratch_dir is None or name is None:
+            return initial_value * np.ones(shape, dtype=np.float16)
+
+        path = os.path.join(self.scratch_dir, name + ".raw")
+        volume = np.memmap(path, dtype=np.float16, mode="w+", shape=tuple(shape))
+        if initial_value != 0.0:  # new files are filled with zeros
+            volume[...] = initial_value
+        return volume
+
+    def _get_grid(self, scene_id, key):
+        name, _, sensor = key.partition("_")
+        if sensor in self.sensors:
+            if name == "tsdf":
+                return self.tsdf[sensor][scene_id].volume
+            elif name == "weights":
+                return self.fusion_weights[sensor][scene_id]
+            elif name == "features":
+                return self.features[sensor][scene_id].volume
+        raise KeyError(key)
+
+    def _set_grid(self, scene_id, key, volume):
+        name, sensor = key.split("_", 1)
+        if name == "tsdf":
+            self.tsdf[sensor][scene_id].volume = volume
+        elif name == "weights":
+            self.fusion_weights[sensor][scene_id] = volume
+        elif name == "features":
+            self.features[sensor][scene_id].volume = volume
+        else:
+            raise KeyError(key)
+
+    def get_resident_volume(self, scene_id, key, device):
+        """Returns a fused grid of a scene as a tensor that stays on the compute device.
+
+        The tensor is updated in place during fusion and only written back to the
+        numpy grids when sync is called. It is kept in the working precision while
+        the numpy grids are stored as float16. On the cpu, the working copy of a
+        memory mapped grid is memory mapped as well.
+
+        Args:
+            scene_id: scene name
+            key: grid name e.g. tsdf_tof, weights_tof or features_tof
+            device: compute device
+
+        Returns:
+            resident tensor
+        """
+        resident = self.resident.setdefault(scene_id, {})
+        if key not in resident:
+            grid = self._get_grid(scene_id, key)
+            if isinstance(grid, np.memmap) and torch.device(device).type == "cpu":
+                resident[key] = self._mapped_working_grid(scene_id, key, grid)
+            else:
+                resident[key] = self.to_working(grid, device)
+
+        return resident[key]
+
+    def _mapped_working_grid(self, scene_id, key, grid):
+        """Returns the working copy of a memory mapped grid on the cpu."""
+        if self.working_dtype == torch.float16:  # the file is updated in place
+            return torch.from_numpy(grid)
+
+        volume = np.memmap(
+            self._working_path(scene_id, key),
+            dtype=np.float32,
+            mode="w+",
+            shape=grid.shape,
+        )
+        for x in range(0, grid.shape[0], self.dirty_block_size):
+            volume[x : x + self.dirty_block_size] = grid[x : x + self.dirty_block_size]
+        return torch.from_numpy(volume)
+
+    def _working_path(self, scene_id, key):
+        return os.path.join(self.scratch_dir, scene_id + "_" + key + ".working.raw")
+
+    def to_working(self, volume, device):
+        """Converts a stored grid to a tensor in the working precision on the device."""
+        if isinstance(volume, np.ndarray):
+            volume = torch.from_numpy(volume)
+        volume = volume.to(device)
+        if self.working_dtype == torch.float32:
+            return volume.float()
+        return volume.half()
+
+    def _to_storage(self, volume):
+        """Converts a grid tensor to the float16 storage on the cpu."""
+        volume = volume.detach().half().cpu()
+        if isinstance(volume, BlockGrid):
+            return volume
+        return volume.numpy()
+
+    def mark_dirty(self, scene_id, indices):
+        """Marks the blocks containing the given linear voxel indices as updated."""
+        grid_shape = self.scenes_gt[scene_id].shape
+        blocks = unravel_index(indices.long(), grid_shape) // self.dirty_block_size
+        with self._dirty_lock:
+            if scene_id not in self.dirty:
+                shape = [math.ceil(s / self.dirty_block_size) for s in grid_shape]
+                self.dirty[scene_id] = torch.zeros(
+                    shape, dtype=torch.bool, device=indices.device
+                )
+            self.dirty[scene_id][blocks[:, 0], blocks[:, 1], blocks[:, 2]] = True
+
+    def pop_dirty(self, scene_id):
+        """Returns the grid of updated blocks of a scene and clears it."""
+        with self._dirty_lock:
+            return self.dirty.pop(scene_id, None)
+
+    def update_volume(self, scene_id, key, volume):
+        """Writes an updated fused grid tensor of a scene back to the database."""
+        grid = self._get_grid(scene_id, key)
+        if not isinstance(grid, np.memmap):
+            self._set_grid(scene_id, key, self._to_storage(volume))
+            return
+
+        volume = volume.detach()
+        if volume.device.type == "cpu" and np.may_share_memory(grid, volume.numpy()):
+            return  # the working copy is the file itself
+
+        # the file is updated in place, slab by slab to bound the memory
+        for x in range(0, grid.shape[0], self.dirty_block_size):
+            slab = volume[x : x + self.dirty_block_size]
+            grid[x : x + self.dirty_block_size] = self._to_storage(slab)
+        self._remove_working_grid(scene_id, key)
+
+    def _remove_working_grid(self, scene_id, key):
+        if self.scratch_dir is None:
+            return
+        path = self._working_path(scene_id, key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _reset_grid(self, scene_id, key, initial_value=0.0):
+        grid = self._get_grid(scene_id, key)
+        if isinstance(grid, np.memmap):
+            grid[...] = initial_value
+        else:
+            self._set_grid(scene_id, key, self._empty_grid(grid.shape, initial_value))
 
-        if self.transform is not None:
-            sample = self.transform(sample)
+    def sync(self, scene_id=None):
+        """Writes the resident grids back to the numpy grids and releases them from the device."""
+        if scene_id:
+            scenes = [scene_id]
+        else:
+            scenes = list(self.resident.keys())
 
-        return sample
+        for scene in scenes:
+            for key, volume in self.resident.pop(scene, {}).items():
+                self.update_volume(scene, key, volume)
 
     def __len__(self):
         return len(self.scenes_gt)
 
     def save(self, path, scene_id=None):
 
+        self.sync(scene_id)
+
         for sensor in self.sensors:
             filename = scene_id + "_" + sensor + ".tsdf.hf5"
             weightname = scene_id + "_" + sensor + ".weights.hf5"
@@ -121,7 +330,7 @@ class Database(Dataset):
                 hf.create_dataset(
                     "TSDF",
                     shape=self.tsdf[sensor][scene_id].volume.shape,
-                    data=self.tsdf[sensor][scene_id].volume,
+                    data=to_numpy(self.tsdf[sensor][scene_id].volume),
                     compression="gzip",
                     compression_opts=9,
                 )
@@ -129,7 +338,7 @@ class Database(Dataset):
                 hf.create_dataset(
                     "weights",
                     shape=self.fusion_weights[sensor][scene_id].shape,
-                    data=self.fusion_weights[sensor][scene_id],
+                    data=to_numpy(self.fusion_weights[sensor][scene_id]),
                     compression="gzip",
                     compression_opts=9,
                 )
@@ -157,6 +366,8 @@ class Database(Dataset):
 
     def evaluate(self, mode="train", workspace=None):
 
+        self.sync()
+
         eval_results = {}
         eval_results_scene_save = {}
         for sensor in self.sensors:
@@ -174,24 +385,24 @@ class Database(Dataset):
                 print("Evaluating ", scene_id, "...")
             else:
                 workspace.log("Evaluating {} ...".format(scene_id), mode)
-            est = {}
             mask, mask_filt = self.get_evaluation_masks(scene_id)
 
-            for sensor in self.sensors:
-                est[sensor] = self.tsdf[sensor][scene_id].volume
-
             est_filt = self.filtered[scene_id].volume
             gt = self.scenes_gt[scene_id].volume
 
             eval_results_scene = dict()
             for sensor_ in self.sensors:
+                # only the masked voxels are read from the (sparse) tsdf grid
+                voxels = np.argwhere(mask[sensor_])
+                est = voxel_values(self.tsdf[sensor_][scene_id].volume, voxels)
                 eval_results_scene[sensor_] = evaluation(
-                    est[sensor_], gt, mask[sensor_]
+                    est, voxel_values(gt, voxels), np.ones(est.shape, dtype=bool)
                 )
+                del voxels, est
 
             eval_results_scene_filt = evaluation(est_filt, gt, mask_filt)
 
-            del est, gt, mask, est_filt, mask_filt
+            del gt, mask, est_filt, mask_filt
 
             for sensor in self.sensors:
                 eval_results_scene_save[sensor][scene_id] = eval_results_scene[sensor]
@@ -238,41 +449,35 @@ class Database(Dataset):
 
     def reset(self, scene_id=None):
         if scene_id:
-            for sensor in self.sensors:
-                self.tsdf[sensor][scene_id].volume = self.initial_value * np.ones(
-                    self.scenes_gt[scene_id].shape, dtype=np.float16
-                )
-                self.fusion_weights[sensor][scene_id] = np.zeros(
-                    self.scenes_gt[scene_id].shape, dtype=np.float16
-                )
-                self.features[sensor][scene_id].volume = np.zeros(
-                    self.features[sensor][scene_id].shape, dtype=np.float16
-                )
+            self.resident.pop(scene_id, None)
+            self.dirty.pop(scene_id, None)
+            scenes = [scene_id]
         else:
-            for scene_id in self.scenes_gt.keys():
-                for sensor in self.sensors:
-                    self.tsdf[sensor][scene_id].volume = self.initial_value * np.ones(
-                        self.scenes_gt[scene_id].shape, dtype=np.float16
-                    )
-                    self.fusion_weights[sensor][scene_id] = np.zeros(
-                        self.scenes_gt[scene_id].shape, dtype=np.float16
-                    )
-                    self.features[sensor][scene_id].volume = np.zeros(
-                        self.features[sensor][scene_id].shape, dtype=np.float16
-                    )
+            self.resident = {}
+            self.dirty = {}
+            scenes = self.scenes_gt.keys()
+
+        for scene_id in scenes:
+            for sensor in self.sensors:
+                for key in ["tsdf_", "weights_", "features_"]:
+                    self._remove_working_grid(scene_id, key + sensor)
+                self._reset_grid(scene_id, "tsdf_" + sensor, self.initial_value)
+                self._reset_grid(scene_id, "weights_" + sensor)
+                self._reset_grid(scene_id, "features_" + sensor)
 
     def get_evaluation_masks(self, scene):
         sensor_mask = {}
-        mask = np.zeros_like(self[scene]["gt"])
-        and_mask = np.ones_like(self[scene]["gt"])
-        filter_mask = np.zeros_like(self[scene]["gt"])
+        gt = self.scenes_gt[scene].volume
+        mask = np.zeros_like(gt)
+        and_mask = np.ones_like(gt)
+        filter_mask = np.zeros_like(gt)
         sensor_mask_filtering = {}
 
         for sensor_ in self.sensors:
-            weights = self.fusion_weights[sensor_][scene]
-            mask = np.logical_or(mask, weights > 0)
-            and_mask = np.logical_and(and_mask, weights > 0)
-            sensor_mask[sensor_] = weights > 0
+            observed = occupancy(self.fusion_weights[sensor_][scene])
+            mask = np.logical_or(mask, observed)
+            and_mask = np.logical_and(and_mask, observed)
+            sensor_mask[sensor_] = observed
 
         # load weighting sensor grid
         if self.outlier_channel:
@@ -298,3 +503,30 @@ class Database(Dataset):
             filter_mask = np.logical_or(filter_mask, sensor_mask_filtering[sensor_] > 0)
 
         return sensor_mask, filter_mask
+
+
+class SceneView(Mapping):
+    """Lazy view on the grids of a scene in the database.
+
+    Keys are only fetched and transformed when they are accessed and the
+    result is cached, so a view should be held for the duration of one step.
+    """
+
+    def __init__(self, database, scene_id):
+        self._database = database
+        self._scene_id = scene_id
+        self._cache = {}
+
+    def __getitem__(self, key):
+        if key not in self._cache:
+            value = self._database.get_value(self._scene_id, key)
+            if self._database.transform is not None:
+                value = self._database.transform({key: value})[key]
+            self._cache[key] = value
+        return self._cache[key]
+
+    def __iter__(self):
+        return iter(self._database.scene_keys(self._scene_id))
+
+    def __len__(self):
+        return len(self._database.scene_keys(self._scene_id))
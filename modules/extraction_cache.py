@@ -0,0 +1,94 @@
+import os
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+class ExtractionCache:
+    """LRU cache of the ray samples of the frames, i.e. the voxel indices and the
+    update weights along the rays.
+
+    The samples only depend on the depth maps, the cameras and the grid geometry,
+    so they can be reused across epochs and validation runs as long as the depth
+    maps do not change, i.e. when the routing network is off or frozen.
+    The samples are stored as .npy files, which are memory mapped when they are
+    read back. The weights of nearest neighbor extraction are all ones and are
+    not stored at all. The least recently used entries are removed once the files
+    exceed size MB.
+    """
+
+    def __init__(self, directory=None, size=0):
+
+        # the files only live as long as the cache
+        self._directory = tempfile.TemporaryDirectory(
+            prefix="extraction_cache_", dir=directory or None
+        )
+        self.max_bytes = size * 2 ** 20  # 0 for no limit
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, device):
+        """Returns the cached samples of a key on the device or None."""
+
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            entry, _ = self._entries[key]
+
+            # copy on write mappings, the pages are only read when accessed. The
+            # files are mapped before they can be evicted
+            arrays = {
+                name: np.load(path, mmap_mode="c")
+                for name, path in entry.items()
+                if path is not None
+            }
+
+        samples = dict()
+        for name, array in arrays.items():
+            samples[name] = torch.from_numpy(array).to(device)
+
+        for name, path in entry.items():
+            if path is None:  # weights of ones of the same shape as the indices
+                indices = samples[name.replace("weights", "indices")]
+                samples[name] = torch.ones(indices.shape, device=device)
+
+        return samples
+
+    def put(self, key, samples):
+        """Stores the samples of a key and returns them."""
+
+        with self._lock:
+            prefix = os.path.join(self._directory.name, str(self._count))
+            self._count += 1
+
+        entry = dict()
+        n_bytes = 0
+        for name, value in samples.items():
+            if name.startswith("weights") and bool((value == 1.0).all()):
+                entry[name] = None
+                continue
+
+            # the indices are int32 (int64 keys of the carved voxels), the weights float32
+            entry[name] = prefix + "_" + name + ".npy"
+            array = value.detach().cpu().numpy()
+            np.save(entry[name], array)
+            n_bytes += array.nbytes
+
+        with self._lock:
+            self._entries[key] = (entry, n_bytes)
+            self._bytes += n_bytes
+            while self.max_bytes > 0 and self._bytes > self.max_bytes:
+                _, (evicted, evicted_bytes) = self._entries.popitem(last=False)
+                self._bytes -= evicted_bytes
+                for path in evicted.values():
+                    if path is not None:
+                        os.remove(path)
+
+        return samples
@@ -2,25 +2,33 @@ import torch
 from torch import nn
 from torch.nn.functional import normalize
 
+from modules.voxelgrid import crop
+from modules.voxelgrid import get_active_region
+from modules.voxelgrid import ravel_index
+from modules.voxelgrid import take
+
 
 class Extractor(nn.Module):
     """
     This module extracts the necessary information from the grids within the viewing frustum of the current frame.
     """
 
-    def __init__(self, config, sensor):
+    def __init__(self, config, spec, cache=None):
 
         super(Extractor, self).__init__()
 
         self.config = config
-        try:
-            self.n_points = eval("self.config.n_points_" + sensor)
-        except AttributeError:
-            self.n_points = self.config.n_points
+        self.sensor = spec.name
+        self.n_points = spec.n_points
+        self.cache = cache  # optional ExtractionCache of the ray samples
+        self.block_size = config.block_size  # alignment of the active regions
         self.mode = "ray"
         self.n_empty_space_voting = config.n_empty_space_voting
+        self.empty_space_carving = config.empty_space_carving
         self.init_val = config.init_value
         self.extraction_strategy = config.extraction_strategy
+        self._offsets = dict()  # sample offsets along the ray per band layout and device
+        self._rays = dict()  # unit-depth camera rays per image size and intrinsics
 
     def forward(
         self,
@@ -33,6 +41,10 @@ class Extractor(nn.Module):
         resolution,
         gpu,
         weights_volume,
+        mask=None,
+        key=None,
+        active_region=False,
+        carve_mask=None,
     ):
         """Computes the forward pass of extracting the rays/blocks and the corresponding coordinates.
 
@@ -46,6 +58,16 @@ class Extractor(nn.Module):
             resolution: resolution of voxel volume
             g: true when using gpu
             weights_volume: current state of reconstruction weight volume
+            mask: optional boolean mask of shape (b, h, w). When given, only the rays
+                through the pixels in the mask are extracted and the outputs are
+                compacted to a single batch of n_valid rays, i.e. (1, n_valid, ...)
+            key: optional key of the frames and the mask. With a cache, the ray
+                samples of a key are only computed once and reused afterwards
+            active_region: when True, only the block aligned region of the grids
+                touched by the rays is read and moved to the device. The indices
+                are then linear indices within the region, which is returned too
+            carve_mask: optional boolean mask of shape (b, h, w) of the rays used for
+                empty space carving when no mask is given. By default all rays
 
         Returns:
             dict: values/voxels of current reconstruction volume as well as at its indices
@@ -53,25 +75,90 @@ class Extractor(nn.Module):
         intrinsics = intrinsics.float()
         extrinsics = extrinsics.float()
 
-        if (
-            torch.cuda.is_available() and gpu
-        ):  # putting extractor on gpu. This makes computations much faster
-            intrinsics = intrinsics.cuda()
+        gpu = torch.cuda.is_available() and gpu
+        if gpu:  # putting extractor on gpu. This makes computations much faster
             extrinsics = extrinsics.cuda()
+            origin = origin.cuda()
+
+        use_cache = self.cache is not None and key is not None
+        if use_cache:
+            key = (self.sensor, active_region) + key
+
+        samples = None
+        if use_cache:
+            samples = self.cache.get(key, extrinsics.device)
+
+        if samples is None:
+            samples = self.ray_samples(
+                depth,
+                extrinsics,
+                intrinsics,
+                origin,
+                resolution,
+                tsdf_volume.shape,
+                mask,
+                active_region,
+                carve_mask,
+            )
+            if use_cache:
+                samples = self.cache.put(key, samples)
+
+        if active_region:
+            region = samples["region"].tolist()
+            tsdf_volume = crop(tsdf_volume, region)
+            weights_volume = crop(weights_volume, region)
 
+        if gpu:
             tsdf_volume = tsdf_volume.cuda()
             weights_volume = weights_volume.cuda()
-            origin = origin.cuda()
 
+        output = self.read_values(samples, tsdf_volume, weights_volume)
+
+        del extrinsics, intrinsics, origin, weights_volume, tsdf_volume
+
+        return output
+
+    def ray_samples(
+        self,
+        depth,
+        extrinsics,
+        intrinsics,
+        origin,
+        resolution,
+        shape,
+        mask=None,
+        active_region=False,
+        carve_mask=None,
+    ):
+        """Computes the voxels sampled along the rays and their update weights.
+
+        The samples only depend on the depth map, the camera and the grid geometry
+        but not on the state of the grids.
+
+        Returns:
+            dict with the int32 linear voxel indices and the update weights of the
+            band (and empty space) samples. With empty space carving, the unique
+            keys of the carved and of the band voxels of every frame, see
+            frame_keys. With active_region, the indices are relative to the
+            returned region of the grid
+        """
         b, h, w = depth.shape
 
-        coords = self.compute_coordinates(
-            depth, extrinsics, intrinsics, origin, resolution, gpu
-        )
+        rays = self.camera_rays(intrinsics, h, w, extrinsics.device)
 
         # compute rays
         eye_w = extrinsics[:, :3, 3]
 
+        if mask is not None:
+            mask = mask.to(extrinsics.device)
+            coords = self.compute_coordinates(depth, extrinsics, rays, mask)
+            batch, _ = torch.nonzero(mask.view(b, h * w), as_tuple=True)
+            coords = coords.unsqueeze(0)
+            eye_w = eye_w[batch].unsqueeze(0)
+        else:
+            coords = self.compute_coordinates(depth, extrinsics, rays)
+            eye_w = eye_w.unsqueeze(1)
+
         points_dict = self.extract_values(
             coords,
             eye_w,
@@ -81,63 +168,180 @@ class Extractor(nn.Module):
             n_empty_space_voting=self.n_empty_space_voting,
         )
 
+        if self.empty_space_carving:
+            # the rays are carved from the camera to the front of the band
+            eye = points_dict["eye"].reshape(-1, 3)
+            end = points_dict["carve_end"].reshape(-1, 3)
+
+            # the frame of every ray, the voxels are carved once per frame
+            if mask is not None:
+                frame = batch
+            else:
+                frame = torch.arange(b, device=eye.device).repeat_interleave(h * w)
+
+            carved = torch.ones_like(frame, dtype=torch.bool)
+            if mask is None and carve_mask is not None:
+                carved = carve_mask.to(eye.device).view(-1)
+
+            # only the part of the segments inside of the grid is traversed
+            eye, end, inside = clip_segments(eye[carved], end[carved], shape)
+            frame_carved = frame[carved][inside]
+
+        offset = None
+        if active_region:
+            # the region of the grid that contains all voxels touched by the samples
+            points = [points_dict["points"].reshape(-1, 3)]
+            if self.n_empty_space_voting > 0:
+                points.append(points_dict["empty_points"].reshape(-1, 3))
+            if self.empty_space_carving:
+                points += [eye, end]
+            region = get_active_region(torch.cat(points), shape, self.block_size)
+
+            offset = torch.tensor([r[0] for r in region], device=depth.device)
+            shape = tuple(r[1] - r[0] for r in region)
+
         if self.extraction_strategy == "trilinear_interpolation":
-            output = self.trilinear_interpolation(
-                points_dict, tsdf_volume, weights_volume
-            )
+            output = self.trilinear_interpolation(points_dict, shape, offset)
 
         elif self.extraction_strategy == "nearest_neighbor":
-            output = self.nearest_neighbor_extraction(
-                points_dict, tsdf_volume, weights_volume
+            output = self.nearest_neighbor_extraction(points_dict, shape, offset)
+
+        if self.empty_space_carving:
+            output["indices_carved"] = traverse(eye, end, shape, offset, frame_carved)
+            output["indices_band"] = frame_keys(
+                output["indices"].view(frame.shape[0], -1)[carved],
+                frame[carved],
+                shape,
             )
 
-        del extrinsics, intrinsics, origin, weights_volume, tsdf_volume
+        if active_region:
+            output["region"] = torch.tensor(region)
 
         return output
 
-    def compute_coordinates(
-        self, depth: int, extrinsics, intrinsics, origin, resolution, gpu
-    ):
-        b, h, w = depth.shape
-        n_points = h * w
+    def read_values(self, samples, tsdf_volume, weights_volume):
+        """Reads the current tsdf values and weights of the grids at the samples.
+
+        Args:
+            samples: output of ray_samples
 
-        # generate frame meshgrid
-        xx, yy = torch.meshgrid(
-            [torch.arange(h, dtype=torch.float), torch.arange(w, dtype=torch.float)]
+        Returns:
+            dict with the samples as well as the (interpolated) tsdf values and
+            weights along the rays
+        """
+        output = dict(samples)
+
+        b, h, n, k = samples["indices"].shape
+        indices = samples["indices"].contiguous().view(-1)
+
+        # valid indices
+        valid_idx = torch.nonzero(indices >= 0)[:, 0]
+
+        # extract valid tsdf values and weights
+        tsdf = take(tsdf_volume, indices[valid_idx])
+        weights = take(weights_volume, indices[valid_idx])
+
+        # create temporary containers in which we will place the valid values at the valid indices
+        value_container = self.init_val * torch.ones(
+            indices.shape, device=indices.device
         )
+        weight_container = torch.zeros(indices.shape, device=indices.device)
+
+        value_container[valid_idx] = tsdf.float()
+        weight_container[valid_idx] = weights.float()
+
+        del tsdf, weights
+
+        if self.extraction_strategy == "trilinear_interpolation":
+            interpolation_weights = samples["weights"].contiguous().view(-1, 8)
+
+            # trilinear interpolation
+            fusion_values = torch.sum(
+                value_container.view(-1, 8) * interpolation_weights, dim=1
+            )
+            fusion_weights = torch.sum(
+                weight_container.view(-1, 8) * interpolation_weights, dim=1
+            )
+        else:
+            fusion_values = value_container
+            fusion_weights = weight_container
+
+        # if the fusion net from routedfusion is used, pack the input to the fusion network
+        output["fusion_values"] = fusion_values.view(b, h, n)
+        output["fusion_weights"] = fusion_weights.view(b, h, n)
+
+        return output
+
+    def camera_rays(self, intrinsics, h, w, device):
+        """Returns the camera space rays through all pixels at unit depth.
+
+        The rays only depend on the image size and the intrinsics, so they are
+        computed once and cached.
 
-        if torch.cuda.is_available() and gpu:  # putting extractor on gpu
-            xx = xx.cuda()
-            yy = yy.cuda()
+        Args:
+            intrinsics: camera intrinsics of shape (b, 3, 3)
+            h: image height
+            w: image width
+            device: device of the rays
+
+        Returns:
+            rays of shape (b, 3, h * w)
+        """
+        rays = []
+        for K in intrinsics:
+            key = (h, w, device, tuple(K.flatten().tolist()))
+            if key not in self._rays:
+                if len(self._rays) >= 16:  # e.g. intrinsics change every frame
+                    self._rays.clear()
+
+                # generate frame meshgrid
+                xx, yy = torch.meshgrid(
+                    [
+                        torch.arange(h, dtype=torch.float),
+                        torch.arange(w, dtype=torch.float),
+                    ]
+                )
+                points_p = torch.stack(
+                    (yy.reshape(-1), xx.reshape(-1), torch.ones(h * w)), dim=0
+                )
+                self._rays[key] = torch.matmul(K.cpu().inverse(), points_p).to(
+                    device
+                )
+            rays.append(self._rays[key])
 
-        # flatten grid coordinates and bring them to batch size
-        xx = xx.contiguous().view(1, h * w, 1).repeat((b, 1, 1))
-        yy = yy.contiguous().view(1, h * w, 1).repeat((b, 1, 1))
-        zz = depth.contiguous().view(b, h * w, 1)
+        if len(rays) == 1:
+            return rays[0].unsqueeze(0)
+        return torch.stack(rays, dim=0)
 
-        # generate points in pixel space
-        points_p = torch.cat((yy, xx, zz), dim=2).clone()
+    def compute_coordinates(self, depth, extrinsics, rays, mask=None):
+        """Back-projects the depth map to world coordinates.
 
-        # invert
-        intrinsics_inv = intrinsics.inverse().float()
+        Args:
+            depth: depth map of shape (b, h, w)
+            extrinsics: camera to world transformations of shape (b, 4, 4)
+            rays: unit-depth camera rays of shape (b, 3, h * w)
+            mask: optional boolean mask of shape (b, h, w). Only the pixels in the
+                mask are back-projected.
 
-        homogenuous = torch.ones((b, 1, n_points))
+        Returns:
+            world coordinates of shape (b, h * w, 3) or (n_valid, 3) with a mask
+        """
+        b, h, w = depth.shape
+        depth = depth.contiguous().view(b, 1, h * w)
+        rotation = extrinsics[:, :3, :3]
+        translation = extrinsics[:, :3, 3]
 
-        if torch.cuda.is_available() and gpu:
-            homogenuous = homogenuous.cuda()
+        if mask is not None:
+            batch, pixel = torch.nonzero(mask.view(b, h * w), as_tuple=True)
+            points_c = rays[batch, :, pixel] * depth[batch, :, pixel]
+            points_w = torch.matmul(rotation[batch], points_c.unsqueeze(-1))
+            return points_w.squeeze(-1) + translation[batch]
 
         # transform points from pixel space to camera space to world space (p->c->w)
-        points_p[:, :, 0] *= zz[:, :, 0]
-        points_p[:, :, 1] *= zz[:, :, 0]
-        points_c = torch.matmul(
-            intrinsics_inv, torch.transpose(points_p, dim0=1, dim1=2)
-        )
-        points_c = torch.cat((points_c, homogenuous), dim=1)
-        points_w = torch.matmul(extrinsics[:3], points_c)
-        points_w = torch.transpose(points_w, dim0=1, dim1=2)[:, :, :3]
+        points_c = rays * depth
+        points_w = torch.matmul(rotation, points_c) + translation.unsqueeze(-1)
 
-        del xx, yy, homogenuous, points_p, points_c, intrinsics_inv
-        return points_w
+        return torch.transpose(points_w, dim0=1, dim1=2)
 
     def extract_values(
         self,
@@ -158,37 +362,57 @@ class Extractor(nn.Module):
             eye - origin
         ) / resolution  # camera center in the voxel coordinate space
 
-        direction = center_v - eye_v
-        direction = normalize(direction, p=2, dim=2)
+        direction = normalize(center_v - eye_v, p=2, dim=2)
 
-        points = [center_v]
-
-        for i in range(1, n_points + 1):
-            point = center_v + i * bin_size * direction
-            pointN = center_v - i * bin_size * direction
-            points.append(point.clone())
-            points.insert(0, pointN.clone())
-
-        points = torch.stack(points, dim=2)
+        offsets, empty_offsets = self.sample_offsets(
+            n_points, n_empty_space_voting, bin_size, direction.device
+        )
 
-        output["points"] = points
+        # sample the band around the surface as center + offset * direction
+        center_v = center_v.unsqueeze(2)
+        direction = direction.unsqueeze(2)
+        output["points"] = center_v + offsets * direction
 
         if self.n_empty_space_voting > 0:
-            empty_points = []
-            for i in range(1, n_empty_space_voting + 1):
-                point = center_v - (8 * i + n_points) * bin_size * direction
-                empty_points.insert(0, point.clone())
+            output["empty_points"] = center_v + empty_offsets * direction
 
-            empty_points = torch.stack(empty_points, dim=2)
-            output["empty_points"] = empty_points
+        if self.empty_space_carving:
+            # the carved segment ends in front of the first band sample
+            distance = torch.norm(
+                center_v - eye_v.unsqueeze(2), p=2, dim=-1, keepdim=True
+            )
+            distance = torch.clamp(distance - (n_points + 1) * bin_size, min=0.0)
+            output["eye"] = eye_v.expand(center_v.shape[:2] + (3,))
+            output["carve_end"] = eye_v.unsqueeze(2) + distance * direction
 
         return output
 
-    def nearest_neighbor_extraction(self, points_dict, tsdf_volume, weights_volume):
+    def sample_offsets(self, n_points, n_empty_space_voting, bin_size, device):
+        """Returns the offsets of the band and empty space samples along the ray.
+
+        The offsets are ordered from the camera towards the back of the surface and
+        have the shape (n, 1) to broadcast against (b, h * w, 1, 3) ray directions.
+        The tensors are cached per band layout and device.
+        """
+        key = (n_points, n_empty_space_voting, bin_size, device)
+        if key not in self._offsets:
+            offsets = [i * bin_size for i in range(-n_points, n_points + 1)]
+            empty_offsets = [
+                -(8 * i + n_points) * bin_size
+                for i in range(n_empty_space_voting, 0, -1)
+            ]
+            self._offsets[key] = (
+                torch.tensor(offsets, device=device).view(-1, 1),
+                torch.tensor(empty_offsets, device=device).view(-1, 1),
+            )
+
+        return self._offsets[key]
+
+    def nearest_neighbor_extraction(self, points_dict, shape, offset=None):
 
         output = dict()
 
-        x, y, z = tsdf_volume.shape
+        x, y, z = shape[:3]
         b, h, n, dim = points_dict["points"].shape
 
         # convert from floating point voxel coordinate points to discrete indices
@@ -202,35 +426,21 @@ class Extractor(nn.Module):
             dim=-1,
         ).long()
 
+        if offset is not None:  # indices relative to the active region
+            indices = indices - offset
+
         # get valid indices as a boolean grid
         valid = get_index_mask(indices, (x, y, z))
 
-        # valid indices
-        valid_idx = torch.nonzero(valid)[:, 0]
-
-        # extract valid tsdf values and weights
-        tsdf = extract_values(indices, tsdf_volume, valid)
-        weights = extract_values(indices, weights_volume, valid)
-
-        # create temporary containers in which we will place the valid values at the valid indices
-        tsdf_container = self.init_val * torch.ones_like(valid).float()
-        weight_container = torch.zeros_like(valid).float()
-
-        tsdf_container[valid_idx] = tsdf.float()
-        weight_container[valid_idx] = weights.float()
+        # linear voxel indices with -1 for the points outside of the grid
+        indices = linear_index(indices, valid, (x, y, z))
 
         # the update weights are always one with nn extraction
         weights = torch.ones_like(valid).float()
 
-        # if the fusion net from routedfusion is used, pack the input to the fusion network
-        fusion_values = tsdf_container.view(b, h, n)
-        fusion_weights = weight_container.view(b, h, n)
-
-        indices = indices.view(b, h, n, 1, 3)
+        indices = indices.view(b, h, n, 1)
         weights = weights.view(b, h, n, 1)
 
-        del tsdf
-
         if self.n_empty_space_voting > 0:
             # handle the empty points
             b, h, n, dim = points_dict["empty_points"].shape
@@ -245,29 +455,30 @@ class Extractor(nn.Module):
                 ),
                 dim=-1,
             ).long()
+            if offset is not None:
+                indices_empty = indices_empty - offset
+            indices_empty = linear_index(
+                indices_empty, get_index_mask(indices_empty, (x, y, z)), (x, y, z)
+            )
 
             # the empty update weights are always one for nn extraction
             weights_empty = torch.ones(
                 points.shape[0], device=self.config.device
             ).float()
 
-            n1, n2, n3 = fusion_values.shape
-
-            indices_empty = indices_empty.view(n1, n2, self.n_empty_space_voting, 1, 3)
-            weights_empty = weights_empty.view(n1, n2, self.n_empty_space_voting, 1)
+            indices_empty = indices_empty.view(b, h, self.n_empty_space_voting, 1)
+            weights_empty = weights_empty.view(b, h, self.n_empty_space_voting, 1)
 
             output["indices_empty"] = indices_empty
             output["weights_empty"] = weights_empty
 
         # packing
-        output["fusion_values"] = fusion_values
         output["indices"] = indices
         output["weights"] = weights
-        output["fusion_weights"] = fusion_weights
 
         return output
 
-    def trilinear_interpolation(self, points_dict, tsdf_volume, weights_volume):
+    def trilinear_interpolation(self, points_dict, shape, offset=None):
 
         output = dict()
 
@@ -281,107 +492,73 @@ class Extractor(nn.Module):
                 points_dict["empty_points"]
             )
 
-            indices_empty = indices_empty.view(b, h, self.n_empty_space_voting, 8, 3)
+            indices_empty = indices_empty.view(-1, 3).long()
+            if offset is not None:  # indices relative to the active region
+                indices_empty = indices_empty - offset
+            indices_empty = linear_index(
+                indices_empty, get_index_mask(indices_empty, shape), shape
+            )
+
+            indices_empty = indices_empty.view(b, h, self.n_empty_space_voting, 8)
             weights_empty = weights_empty.view(b, h, self.n_empty_space_voting, 8)
             output["weights_empty"] = weights_empty
             output["indices_empty"] = indices_empty
 
-        n1, n2, n3 = indices.shape
-        indices = indices.contiguous().view(n1 * n2, n3).long()
+        indices = indices.contiguous().view(-1, 3).long()
+        if offset is not None:
+            indices = indices - offset
 
         # get valid indices
-        valid = get_index_mask(indices, tsdf_volume.shape)
-        valid_idx = torch.nonzero(valid)[:, 0]
-
-        tsdf_values = extract_values(indices, tsdf_volume, valid)
-        tsdf_weights = extract_values(indices, weights_volume, valid)
-
-        value_container = self.init_val * torch.ones_like(valid).float()
-        weight_container = torch.zeros_like(valid).float()
-
-        value_container[valid_idx] = tsdf_values.float()
-        weight_container[valid_idx] = tsdf_weights.float()
-
-        value_container = value_container.view(weights.shape)
-        weight_container = weight_container.view(weights.shape)
+        valid = get_index_mask(indices, shape)
+        indices = linear_index(indices, valid, shape)
 
-        # trilinear interpolation
-        fusion_values = torch.sum(value_container * weights, dim=1)
-        fusion_weights = torch.sum(weight_container * weights, dim=1)
-        weights = weights.unsqueeze_(-1)
-
-        fusion_values = fusion_values.view(b, h, n)
-        fusion_weights = fusion_weights.view(b, h, n)
-
-        indices = indices.view(n1, n2, n3)
-
-        indices = indices.view(b, h, n, 8, 3)
+        indices = indices.view(b, h, n, 8)
         weights = weights.view(b, h, n, 8)
 
         # packing
-        output["fusion_values"] = fusion_values.float()
         output["indices"] = indices
         output["weights"] = weights
-        output["fusion_weights"] = fusion_weights.float()
 
         return output
 
 
+# offsets of the 8 corner voxels in the order x, y, z
+CORNERS = torch.tensor(
+    [[i, j, k] for i in range(2) for j in range(2) for k in range(2)],
+    dtype=torch.float,
+)
+_corners = dict()  # corner table per device
+
+
 def interpolation_weights(points):
 
     floored = torch.floor(points)
     neighbor = torch.sign(points - floored)  # always one
 
     # index of center voxel
-    idx = torch.floor(points)
+    idx = floored
 
     # reshape for pytorch compatibility
     b, h, n, dim = idx.shape
-    points = points.contiguous().view(b * h * n, dim)
-    floored = floored.contiguous().view(b * h * n, dim)
-    idx = idx.contiguous().view(b * h * n, dim)
-    neighbor = neighbor.contiguous().view(b * h * n, dim)
+    points = points.contiguous().view(b * h * n, 1, dim)
+    floored = floored.contiguous().view(b * h * n, 1, dim)
+    idx = idx.contiguous().view(b * h * n, 1, dim)
+    neighbor = neighbor.contiguous().view(b * h * n, 1, dim)
 
     # center x.0
     alpha = torch.abs(points - floored)  # always positive
     alpha_inv = 1 - alpha
 
-    weights = []
-    indices = []
-
-    for i in range(0, 2):
-        for j in range(0, 2):
-            for k in range(0, 2):
-                if i == 0:
-                    w1 = alpha_inv[:, 0]
-                    ix = idx[:, 0]
-                else:
-                    w1 = alpha[:, 0]
-                    ix = idx[:, 0] + neighbor[:, 0]
-                if j == 0:
-                    w2 = alpha_inv[:, 1]
-                    iy = idx[:, 1]
-                else:
-                    w2 = alpha[:, 1]
-                    iy = idx[:, 1] + neighbor[:, 1]
-                if k == 0:
-                    w3 = alpha_inv[:, 2]
-                    iz = idx[:, 2]
-                else:
-                    w3 = alpha[:, 2]
-                    iz = idx[:, 2] + neighbor[:, 2]
-
-                weights.append((w1 * w2 * w3).unsqueeze_(1))
-                indices.append(
-                    torch.cat(
-                        (ix.unsqueeze_(1), iy.unsqueeze_(1), iz.unsqueeze_(1)), dim=1
-                    ).unsqueeze_(1)
-                )
+    if points.device not in _corners:
+        _corners[points.device] = CORNERS.to(points.device)
+    corners = _corners[points.device]
 
-    weights = torch.cat(weights, dim=1)
-    indices = torch.cat(indices, dim=1)
+    # per corner and axis, weight alpha towards the neighbor and 1 - alpha otherwise
+    factors = torch.where(corners.bool(), alpha, alpha_inv)
+    weights = factors[:, :, 0] * factors[:, :, 1] * factors[:, :, 2]
+    indices = idx + neighbor * corners
 
-    del points, floored, idx, neighbor, alpha, alpha_inv, ix, iy, iz, w1, w2, w3
+    del points, floored, idx, neighbor, alpha, alpha_inv, factors
 
     return weights, indices
 
@@ -402,30 +579,138 @@ def get_index_mask(indices, shape):
     return valid
 
 
-def extract_values(indices, volume, mask=None):
-    if volume.dim() == 3:
-        if mask is not None:
-            x = torch.masked_select(
-                indices[:, 0], mask
-            )  # filters away the indices that are flagged as outside the grid
-            y = torch.masked_select(indices[:, 1], mask)
-            z = torch.masked_select(indices[:, 2], mask)
-        else:
-            x = indices[:, 0]
-            y = indices[:, 1]
-            z = indices[:, 2]
+def linear_index(indices, valid, shape):
+    """Returns the int32 linear voxel indices of (N, 3) indices with -1 where not valid."""
 
-        return volume[x, y, z]
-    else:  # feature volume processing
-        if mask is not None:
-            x = torch.masked_select(
-                indices[:, 0], mask
-            )  # filters away the indices that are flagged as outside the grid
-            y = torch.masked_select(indices[:, 1], mask)
-            z = torch.masked_select(indices[:, 2], mask)
-        else:
-            x = indices[:, 0]
-            y = indices[:, 1]
-            z = indices[:, 2]
+    index = ravel_index(indices, shape)
+
+    return torch.where(valid, index, -torch.ones_like(index))
+
+
+def clip_segments(start, end, shape):
+    """Method to clip line segments to the voxel grid.
+
+    Args:
+        start: start points of the segments in voxel coordinates of shape (N, 3)
+        end: end points of the segments in voxel coordinates of shape (N, 3)
+        shape: shape of the grid
+
+    Returns:
+        start and end points of the segments that intersect the grid, clipped to
+        the grid, and the mask of these segments
+    """
+    lower = -0.5 * torch.ones_like(start[:1])
+    upper = torch.tensor(shape, dtype=start.dtype, device=start.device) - 0.5
+
+    # the segment parameters t of the crossings with the lower and upper planes
+    delta = end - start
+    parallel = delta == 0
+    step = torch.where(parallel, torch.ones_like(delta), delta)
+    t_lower = (lower - start) / step
+    t_upper = (upper - start) / step
+
+    # the segments parallel to the planes of an axis are either between them or not
+    inside = ((start >= lower) & (start <= upper)).to(start.dtype)
+    t_min = torch.where(parallel, 1.0 - inside, torch.min(t_lower, t_upper))
+    t_max = torch.where(parallel, inside, torch.max(t_lower, t_upper))
+
+    t_start = torch.clamp(t_min.max(1)[0], min=0.0)
+    t_end = torch.clamp(t_max.min(1)[0], max=1.0)
+    valid = t_start < t_end
+
+    start, delta = start[valid], delta[valid]
+    return (
+        start + t_start[valid].unsqueeze(1) * delta,
+        start + t_end[valid].unsqueeze(1) * delta,
+        valid,
+    )
+
+
+def frame_keys(indices, frame, shape):
+    """Method to combine linear voxel indices with the frame they belong to.
+
+    The key of the voxel index i of frame f is f * n + i, where n is the number of
+    voxels of the grid, so unique keys are unique voxels per frame.
+
+    Args:
+        indices: linear voxel indices of shape (N, ...), -1 outside of the grid
+        frame: frame of every row of the indices of shape (N,)
+        shape: shape of the grid (or the active region)
+
+    Returns:
+        unique sorted int64 keys of the voxels within the grid
+    """
+    n_voxels = shape[0] * shape[1] * shape[2]
+    frame = frame.view((-1,) + (1,) * (indices.dim() - 1))
+    keys = frame * n_voxels + indices.long()
+
+    return torch.unique(keys[indices >= 0])
+
+
+def traverse(start, end, shape, offset=None, frame=None, max_samples=2 ** 24):
+    """Method to enumerate the voxels traversed by line segments (3D DDA).
+
+    The voxel i covers [i - 0.5, i + 0.5) as with nearest neighbor extraction. All
+    crossings of the segments with the voxel boundaries are computed at once and
+    every voxel between two consecutive crossings is traversed. The segments are
+    processed in chunks of at most max_samples voxels.
+
+    Args:
+        start: start points of the segments in voxel coordinates of shape (N, 3)
+        end: end points of the segments in voxel coordinates of shape (N, 3)
+        shape: shape of the grid (or the active region)
+        offset: optional offset of the active region
+        frame: optional frame of every segment of shape (N,)
+
+    Returns:
+        unique keys of the traversed voxels within the grid per frame, see
+        frame_keys
+    """
+    if frame is None:
+        frame = torch.zeros(start.shape[0], dtype=torch.long, device=start.device)
+
+    start = start + 0.5
+    end = end + 0.5
+    if offset is not None:
+        start = start - offset
+        end = end - offset
+
+    # number of voxel boundaries crossed along every axis
+    n_crossings = (
+        torch.floor(torch.max(start, end)) - torch.floor(torch.min(start, end))
+    ).long()
+
+    n_voxels = int(n_crossings.sum(1).max()) + 1 if start.shape[0] > 0 else 1
+    chunk_size = max(max_samples // n_voxels, 1)
+
+    keys = [torch.zeros((0,), dtype=torch.long, device=start.device)]
+    for i in range(0, start.shape[0], chunk_size):
+        p = start[i : i + chunk_size]
+        delta = end[i : i + chunk_size] - p
+        crossings = n_crossings[i : i + chunk_size]
+        lower = torch.floor(torch.min(p, p + delta))
+
+        # the segment parameters t in [0, 1] of all crossings
+        t = [torch.zeros_like(p[:, :1]), torch.ones_like(p[:, :1])]
+        for axis in range(3):
+            m = int(crossings[:, axis].max())
+            if m == 0:
+                continue
+            steps = torch.arange(m, device=p.device).unsqueeze(0)
+            planes = lower[:, axis : axis + 1] + 1 + steps
+            t_axis = (planes - p[:, axis : axis + 1]) / delta[:, axis : axis + 1]
+            t.append(torch.where(steps < crossings[:, axis : axis + 1], t_axis, t[1]))
+        t = torch.sort(torch.cat(t, dim=1), dim=1)[0]
+
+        # the voxels between consecutive crossings
+        midpoints = 0.5 * (t[:, :-1] + t[:, 1:])
+        voxels = torch.floor(
+            p.unsqueeze(1) + midpoints.unsqueeze(-1) * delta.unsqueeze(1)
+        )
+        voxels = voxels.view(-1, 3).long()
+
+        index = linear_index(voxels, get_index_mask(voxels, shape), shape)
+        index = index.view(p.shape[0], -1)
+        keys.append(frame_keys(index, frame[i : i + chunk_size], shape))
 
-        return volume[x, y, z, :]
+    return torch.unique(torch.cat(keys))
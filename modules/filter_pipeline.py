@@ -1,6 +1,7 @@
 import torch
 
 from modules.filtering_net import *
+from modules.voxelgrid import occupied_voxels, unravel_index
 import math
 import numpy as np
 
@@ -56,11 +57,11 @@ class Filter_Pipeline(torch.nn.Module):
 
         return output
 
-    def _prepare_local_grids(self, bbox, database, scene):
+    def _prepare_local_grids(self, bbox, database, scene, stride, border):
         output = dict()
-        # pad the local grids so that the dimension is divisible by half the chunk size and then ad
-        # the chunk size divided by 4 so that we can update only the central region
-        divisible_by = self.config.FILTERING_MODEL.CONV3D_MODEL.chunk_size / 2
+        # pad the local grids so that the dimension is divisible by the stride and then add
+        # the border so that we can update only the central region
+        divisible_by = stride
         if (
             bbox[0, 1] - bbox[0, 0]
         ) % divisible_by != 0:  # I use 8 here because we need at least 4 due to the box_shift variable regardless
@@ -81,25 +82,25 @@ class Filter_Pipeline(torch.nn.Module):
 
         # pad the local grid
         pad = torch.nn.ReplicationPad3d((0, int(pad_z), 0, int(pad_y), 0, int(pad_x)))
-        # pad the grid with the chunk size divided by 4 along each dimension
-        extra_pad = int(self.config.FILTERING_MODEL.CONV3D_MODEL.chunk_size / 4)
-        extra_pad = torch.nn.ReplicationPad3d(extra_pad)
+        # pad the grid with the border along each dimension
+        extra_pad = torch.nn.ReplicationPad3d(border)
 
+        scene_grids = database[scene]
         for sensor_ in self.config.DATA.input:
             # extract bbox from global grid
-            tsdf = database[scene]["tsdf_" + sensor_][
+            tsdf = scene_grids["tsdf_" + sensor_][
                 bbox[0, 0] : bbox[0, 1],
                 bbox[1, 0] : bbox[1, 1],
                 bbox[2, 0] : bbox[2, 1],
             ]
 
-            weights = database[scene]["weights_" + sensor_][
+            weights = scene_grids["weights_" + sensor_][
                 bbox[0, 0] : bbox[0, 1],
                 bbox[1, 0] : bbox[1, 1],
                 bbox[2, 0] : bbox[2, 1],
             ]
 
-            feat = database[scene]["features_" + sensor_][
+            feat = scene_grids["features_" + sensor_][
                 bbox[0, 0] : bbox[0, 1],
                 bbox[1, 0] : bbox[1, 1],
                 bbox[2, 0] : bbox[2, 1],
@@ -120,44 +121,104 @@ class Filter_Pipeline(torch.nn.Module):
 
         return output, int(pad_x), int(pad_y), int(pad_z)
 
+    def _chunks_per_batch(self, chunk_size, n_channels):
+        """Method to compute how many chunks fit into the memory budget of one
+        forward pass of the filtering network at test time.
+
+        Args:
+            chunk_size: side length of a chunk
+            n_channels: number of input channels per sensor
+
+        Returns:
+            number of chunks per batch
+        """
+        widths = [
+            module.out_channels
+            for module in self._filtering_network.modules()
+            if isinstance(module, torch.nn.Conv3d)
+        ]
+        # the input crops, the concatenated network input and two consecutive
+        # activations of the widest layer are alive at the same time
+        floats = 2 * len(self.config.DATA.input) * n_channels + 2 * max(widths)
+        chunk_bytes = 4 * floats * chunk_size ** 3
+        budget = self.config.FILTERING_MODEL.CONV3D_MODEL.batch_memory * 2 ** 20
+
+        return max(1, int(budget // chunk_bytes))
+
+    def _tiling(self):
+        """Method to get the stride and border of the chunks at test time.
+
+        With halo tiling, the border is the receptive radius of the filtering network
+        so that the kept region is identical to filtering the whole grid at once.
+
+        Returns:
+            stride between the chunks and border around the kept central region
+        """
+        chunk_size = self.config.FILTERING_MODEL.CONV3D_MODEL.chunk_size
+        if self.config.FILTERING_MODEL.CONV3D_MODEL.halo_tiling:
+            border = self._filtering_network.receptive_radius()
+            stride = chunk_size - 2 * border
+            if stride <= 0:
+                raise ValueError(
+                    "chunk_size {} is too small for the receptive radius {}".format(
+                        chunk_size, border
+                    )
+                )
+        else:
+            stride = int(chunk_size / 2)
+            border = int(chunk_size / 4)
+
+        return stride, border
+
+    def _weighted_average(self, local_grids, filtered, sensor_weighting):
+        """Method to fuse the local grids by averaging the sensors with their tsdf weights."""
+        weight_sum = torch.zeros_like(filtered)
+        for sensor_ in self.config.DATA.input:
+            weight_sum += local_grids[sensor_][0, 1]
+            filtered += local_grids[sensor_][0, 0] * local_grids[sensor_][0, 1]
+
+        observed = weight_sum > 0
+        filtered[observed] /= weight_sum[observed]
+        if self.config.FILTERING_MODEL.CONV3D_MODEL.outlier_channel:
+            # only the sensor weighting channel, which is evaluated and visualized,
+            # is set. The outlier channel is left untouched
+            sensor_weighting = sensor_weighting[1]
+        sensor_weighting[observed] = (
+            local_grids[self.config.DATA.input[0]][0, 1][observed]
+            / weight_sum[observed]
+        )
+
     def filter(
         self, scene, database, device
     ):  # here we use a stride which is half the chunk size
         self.device = device
 
-        indices = np.zeros_like(database.scenes_gt[scene].volume)
-        for sensor_ in self.config.DATA.input:
-            indices = np.logical_or(
-                indices, database.fusion_weights[sensor_][scene] > 0
-            )
+        # voxels observed by any sensor, only the allocated bricks of sparse grids
+        # are visited
+        voxels = np.concatenate(
+            [
+                occupied_voxels(database.fusion_weights[sensor_][scene])
+                for sensor_ in self.config.DATA.input
+            ]
+        )
+        observed = np.zeros(database.scenes_gt[scene].shape, dtype=bool)
+        observed[voxels[:, 0], voxels[:, 1], voxels[:, 2]] = True
 
-        uninit_indices = np.invert(indices)
-        indices = np.transpose(indices.nonzero()).astype(np.int16)
-        uninit_indices = np.transpose(uninit_indices.nonzero()).astype(np.int16)
         chunk_size = self.config.FILTERING_MODEL.CONV3D_MODEL.chunk_size
 
-        # get minimum box size
-        x_size = indices[:, 0].max() - indices[:, 0].min()
-        y_size = indices[:, 1].max() - indices[:, 1].min()
-        z_size = indices[:, 2].max() - indices[:, 2].min()
+        # get minimum box size. + 1 here because we want to include the max index in the
+        # bbox because we later do min:max during extraction
+        bbox = np.stack((voxels.min(axis=0), voxels.max(axis=0) + 1), axis=1)
+        del voxels
 
-        bbox = np.array(
-            [
-                [
-                    indices[:, 0].min(),
-                    indices[:, 0].min() + x_size + 1,
-                ],  # + 1 here because we want to include the max index in the bbox because we later do min:max during extraction
-                [
-                    indices[:, 1].min(),
-                    indices[:, 1].min() + y_size + 1,
-                ],  # + 1 here because we want to include the max index in the bbox because we later do min:max during extraction
-                [indices[:, 2].min(), indices[:, 2].min() + z_size + 1],
-            ]
-        )  # + 1 here because we want to include the max index in the bbox because we later do min:max during extraction
+        # traverse the local grid with chunks that overlap by twice the border and keep
+        # the central region of every chunk. The chunks are fed to the filtering network
+        # in batches.
+        stride, border = self._tiling()
 
         # prepare local grids
         local_grids, pad_x, pad_y, pad_z = self._prepare_local_grids(
-            bbox, database, scene
+            bbox, database, scene, stride, border
         )
 
         filtered_local_grid = torch.zeros(
@@ -171,115 +232,111 @@ class Filter_Pipeline(torch.nn.Module):
                 (sensor_weighting_local_grid, sensor_weighting_local_grid), dim=0
             )
 
-        # traverse the local grid, extracting chunks from the local grid to feed to the
-        # filtering network one at a time.
-        moving_bbox = np.zeros_like(bbox)
-
-        x_size, y_size, z_size = local_grids[self.config.DATA.input[0]][
-            0, 0, :, :, :
-        ].shape
-        for i in range(
-            math.ceil(2 * x_size / chunk_size) - 1
-        ):  # multiply by 2 since we have a stride that is half the chunk size
-            moving_bbox[0, 0] = (
-                i * 0.5 * chunk_size
-            )  # multiply by 0.5 because the stride is half the chunk size
-            moving_bbox[0, 1] = moving_bbox[0, 0] + chunk_size
-            for j in range(math.ceil(2 * y_size / chunk_size) - 1):
-                moving_bbox[1, 0] = j * 0.5 * chunk_size
-                moving_bbox[1, 1] = moving_bbox[1, 0] + chunk_size
-                for k in range(math.ceil(2 * z_size / chunk_size) - 1):
-                    moving_bbox[2, 0] = k * 0.5 * chunk_size
-                    moving_bbox[2, 1] = moving_bbox[2, 0] + chunk_size
-
-                    input_ = dict()
-                    for sensor_ in self.config.DATA.input:
-                        input_[sensor_] = local_grids[sensor_][
-                            :,
-                            :,
-                            moving_bbox[0, 0] : moving_bbox[0, 1],
-                            moving_bbox[1, 0] : moving_bbox[1, 1],
-                            moving_bbox[2, 0] : moving_bbox[2, 1],
-                        ].to(self.device)
-
-                    with torch.no_grad():
-                        input_["test_mode"] = True
-                        sub_filter_dict = self._filtering(input_)
-                        if sub_filter_dict is None:
-                            print("encountered nan in filtering net. Exit")
-                            return
-
-                    del input_
-
-                    sensor_weighting = (
-                        sub_filter_dict["sensor_weighting"].cpu().detach()
-                    )
-                    if self.config.FILTERING_MODEL.CONV3D_MODEL.outlier_channel:
-                        sensor_weighting_local_grid[
-                            :,
-                            moving_bbox[0, 0]
-                            + int(chunk_size / 4) : moving_bbox[0, 1]
-                            - int(chunk_size / 4),
-                            moving_bbox[1, 0]
-                            + int(chunk_size / 4) : moving_bbox[1, 1]
-                            - int(chunk_size / 4),
-                            moving_bbox[2, 0]
-                            + int(chunk_size / 4) : moving_bbox[2, 1]
-                            - int(chunk_size / 4),
-                        ] = sensor_weighting[
-                            :,
-                            int(chunk_size / 4) : -int(chunk_size / 4),
-                            int(chunk_size / 4) : -int(chunk_size / 4),
-                            int(chunk_size / 4) : -int(chunk_size / 4),
-                        ]
-                    else:
-                        sensor_weighting_local_grid[
-                            moving_bbox[0, 0]
-                            + int(chunk_size / 4) : moving_bbox[0, 1]
-                            - int(chunk_size / 4),
-                            moving_bbox[1, 0]
-                            + int(chunk_size / 4) : moving_bbox[1, 1]
-                            - int(chunk_size / 4),
-                            moving_bbox[2, 0]
-                            + int(chunk_size / 4) : moving_bbox[2, 1]
-                            - int(chunk_size / 4),
-                        ] = sensor_weighting[
-                            int(chunk_size / 4) : -int(chunk_size / 4),
-                            int(chunk_size / 4) : -int(chunk_size / 4),
-                            int(chunk_size / 4) : -int(chunk_size / 4),
-                        ]
-
-                    sub_tsdf = sub_filter_dict["tsdf"].cpu().detach()
-
-                    del sub_filter_dict
-
-                    # insert sub_tsdf into the local filtered grid
-                    filtered_local_grid[
-                        moving_bbox[0, 0]
-                        + int(chunk_size / 4) : moving_bbox[0, 1]
-                        - int(chunk_size / 4),
-                        moving_bbox[1, 0]
-                        + int(chunk_size / 4) : moving_bbox[1, 1]
-                        - int(chunk_size / 4),
-                        moving_bbox[2, 0]
-                        + int(chunk_size / 4) : moving_bbox[2, 1]
-                        - int(chunk_size / 4),
-                    ] = sub_tsdf[
-                        int(chunk_size / 4) : -int(chunk_size / 4),
-                        int(chunk_size / 4) : -int(chunk_size / 4),
-                        int(chunk_size / 4) : -int(chunk_size / 4),
-                    ]
-
-                    del sub_tsdf
+        patches = dict()
+        for sensor_ in self.config.DATA.input:
+            # view of all chunks of shape (C, nx, ny, nz, chunk, chunk, chunk)
+            patches[sensor_] = (
+                local_grids[sensor_][0]
+                .unfold(1, chunk_size, stride)
+                .unfold(2, chunk_size, stride)
+                .unfold(3, chunk_size, stride)
+            )
+
+        # only feed the chunks whose central region contains observed voxels
+        n_chunks = patches[self.config.DATA.input[0]].shape[1:4]
+        local_observed = observed[
+            bbox[0, 0] : bbox[0, 1], bbox[1, 0] : bbox[1, 1], bbox[2, 0] : bbox[2, 1]
+        ]
+        if self.config.FILTERING_MODEL.CONV3D_MODEL.narrow_band:
+            # voxels outside the truncation band are fused by weighted averaging
+            self._weighted_average(
+                local_grids, filtered_local_grid, sensor_weighting_local_grid
+            )
+            # the grids are stored in float16, where a truncated voxel is not
+            # exactly trunc_value, so values within one ulp count as truncated
+            trunc_value = np.float16(self.config.DATA.trunc_value)
+            trunc_value = trunc_value - np.spacing(trunc_value)
+            band = np.zeros_like(local_observed)
+            for sensor_ in self.config.DATA.input:
+                local_grid = local_grids[sensor_][
+                    0,
+                    :,
+                    border : border + local_observed.shape[0],
+                    border : border + local_observed.shape[1],
+                    border : border + local_observed.shape[2],
+                ].numpy()
+                band |= (local_grid[1] > 0) & (np.abs(local_grid[0]) < trunc_value)
+            occupied = chunk_occupancy(band, stride, n_chunks)
+        else:
+            occupied = chunk_occupancy(local_observed, stride, n_chunks)
+        chunks = np.transpose(occupied.nonzero())
+        del local_observed
+        batch_size = self._chunks_per_batch(
+            chunk_size, local_grids[self.config.DATA.input[0]].shape[1]
+        )
+
+        keep = torch.arange(stride)
+        for b in range(0, chunks.shape[0], batch_size):
+            batch = torch.from_numpy(chunks[b : b + batch_size])
+            n = batch.shape[0]
+
+            input_ = dict()
+            for sensor_ in self.config.DATA.input:
+                input_[sensor_] = (
+                    patches[sensor_][:, batch[:, 0], batch[:, 1], batch[:, 2]]
+                    .transpose(0, 1)
+                    .to(self.device)
+                )
+
+            with torch.no_grad():
+                input_["test_mode"] = True
+                sub_filter_dict = self._filtering(input_)
+                if sub_filter_dict is None:
+                    print("encountered nan in filtering net. Exit")
+                    return
+
+            del input_
+
+            # indices of the central regions in the local grid
+            x = (batch[:, 0:1] * stride + border + keep).view(n, -1, 1, 1)
+            y = (batch[:, 1:2] * stride + border + keep).view(n, 1, -1, 1)
+            z = (batch[:, 2:3] * stride + border + keep).view(n, 1, 1, -1)
+            center = slice(border, border + stride)
+
+            sensor_weighting = sub_filter_dict["sensor_weighting"].cpu().detach()
+            if self.config.FILTERING_MODEL.CONV3D_MODEL.outlier_channel:
+                sensor_weighting = sensor_weighting.view(
+                    n, 2, chunk_size, chunk_size, chunk_size
+                )
+                sensor_weighting_local_grid[:, x, y, z] = sensor_weighting[
+                    :, :, center, center, center
+                ].transpose(0, 1)
+            else:
+                sensor_weighting = sensor_weighting.view(
+                    n, chunk_size, chunk_size, chunk_size
+                )
+                sensor_weighting_local_grid[x, y, z] = sensor_weighting[
+                    :, center, center, center
+                ]
+
+            sub_tsdf = sub_filter_dict["tsdf"].cpu().detach()
+            sub_tsdf = sub_tsdf.view(n, chunk_size, chunk_size, chunk_size)
+
+            del sub_filter_dict
+
+            # insert sub_tsdf into the local filtered grid
+            filtered_local_grid[x, y, z] = sub_tsdf[:, center, center, center]
+
+            del sub_tsdf, sensor_weighting
 
         # transfer the local_filtered_grid to the global grid
         # first remove the padding
         if self.config.FILTERING_MODEL.CONV3D_MODEL.outlier_channel:
             sensor_weighting_local_grid = sensor_weighting_local_grid[
                 :,
-                int(chunk_size / 4) : -int(chunk_size / 4) - pad_x,
-                int(chunk_size / 4) : -int(chunk_size / 4) - pad_y,
-                int(chunk_size / 4) : -int(chunk_size / 4) - pad_z,
+                border : border + bbox[0, 1] - bbox[0, 0],
+                border : border + bbox[1, 1] - bbox[1, 0],
+                border : border + bbox[2, 1] - bbox[2, 0],
             ]
 
             database.sensor_weighting[scene][
@@ -290,14 +347,12 @@ class Filter_Pipeline(torch.nn.Module):
             ] = sensor_weighting_local_grid.numpy().squeeze()
             # I write to all voxels in the local grid, even the uninitialized, but here I replace the uninitialized
             # voxel values with their default value
-            database.sensor_weighting[scene][
-                :, uninit_indices[:, 0], uninit_indices[:, 1], uninit_indices[:, 2]
-            ] = -1
+            database.sensor_weighting[scene][:, ~observed] = -1
         else:
             sensor_weighting_local_grid = sensor_weighting_local_grid[
-                int(chunk_size / 4) : -int(chunk_size / 4) - pad_x,
-                int(chunk_size / 4) : -int(chunk_size / 4) - pad_y,
-                int(chunk_size / 4) : -int(chunk_size / 4) - pad_z,
+                border : border + bbox[0, 1] - bbox[0, 0],
+                border : border + bbox[1, 1] - bbox[1, 0],
+                border : border + bbox[2, 1] - bbox[2, 0],
             ]
 
             database.sensor_weighting[scene][
@@ -307,15 +362,13 @@ class Filter_Pipeline(torch.nn.Module):
             ] = sensor_weighting_local_grid.numpy().squeeze()
             # I write to all voxels in the local grid, even the uninitialized, but here I replace the uninitialized
             # voxel values with their default value
-            database.sensor_weighting[scene][
-                uninit_indices[:, 0], uninit_indices[:, 1], uninit_indices[:, 2]
-            ] = -1
+            database.sensor_weighting[scene][~observed] = -1
         del sensor_weighting_local_grid
 
         filtered_local_grid = filtered_local_grid[
-            int(chunk_size / 4) : -int(chunk_size / 4) - pad_x,
-            int(chunk_size / 4) : -int(chunk_size / 4) - pad_y,
-            int(chunk_size / 4) : -int(chunk_size / 4) - pad_z,
+            border : border + bbox[0, 1] - bbox[0, 0],
+            border : border + bbox[1, 1] - bbox[1, 0],
+            border : border + bbox[2, 1] - bbox[2, 0],
         ]
 
         database.filtered[scene].volume[
@@ -324,18 +377,136 @@ class Filter_Pipeline(torch.nn.Module):
 
         # I write to all voxels in the local grid, even the uninitialized, but here I replace the uninitialized
         # voxel values with their default value
-        database.filtered[scene].volume[
-            uninit_indices[:, 0], uninit_indices[:, 1], uninit_indices[:, 2]
-        ] = self.config.DATA.init_value
+        database.filtered[scene].volume[~observed] = self.config.DATA.init_value
 
         del filtered_local_grid
 
+    def filter_incremental(self, scene, database, device):
+        """Method to refilter only the chunks whose input changed since the last pass.
+
+        The chunks are tiled on the whole scene grid, so the outputs of unchanged
+        chunks stay valid in the filtered and sensor weighting grids and are reused.
+        A chunk is refiltered when its input window overlaps a block that the
+        integrator updated since the last pass. At the scene boundary the chunks are
+        padded by replication.
+
+        Args:
+            scene: scene name
+            database: database holding the fused grids
+            device: compute device
+        """
+        self.device = device
+
+        dirty = database.pop_dirty(scene)
+        if dirty is None:
+            return
+
+        chunk_size = self.config.FILTERING_MODEL.CONV3D_MODEL.chunk_size
+        stride, border = self._tiling()
+        shape = database.scenes_gt[scene].shape
+        n_chunks = [math.ceil(s / stride) for s in shape]
+
+        chunks = dirty_chunks(
+            dirty, database.dirty_block_size, stride, border, n_chunks
+        )
+        scene_grids = database[scene]
+        batch_size = self._chunks_per_batch(
+            chunk_size, 2 + self.config.FEATURE_MODEL.n_features
+        )
+
+        window = torch.arange(chunk_size) - border
+        keep = torch.arange(stride)
+        center = slice(border, border + stride)
+        for b in range(0, chunks.shape[0], batch_size):
+            batch = chunks[b : b + batch_size]
+            n = batch.shape[0]
+
+            # gather the input windows of the chunks, clamped to the scene grid
+            window_indices = [
+                (batch[:, i : i + 1] * stride + window).clamp(0, shape[i] - 1)
+                for i in range(3)
+            ]
+
+            input_ = dict()
+            observed = torch.zeros((n, stride, stride, stride), dtype=torch.bool)
+            for sensor_ in self.config.DATA.input:
+                tsdf = scene_grids["tsdf_" + sensor_]
+                x, y, z = [
+                    indices.to(tsdf.device).view(view)
+                    for indices, view in zip(
+                        window_indices, [(n, -1, 1, 1), (n, 1, -1, 1), (n, 1, 1, -1)]
+                    )
+                ]
+                weights = scene_grids["weights_" + sensor_][x, y, z]
+                feat = scene_grids["features_" + sensor_][x, y, z]
+                local_grid = torch.cat(
+                    (
+                        tsdf[x, y, z].unsqueeze(1),
+                        weights.unsqueeze(1),
+                        feat.permute(0, 4, 1, 2, 3),
+                    ),
+                    dim=1,
+                )
+                observed |= (weights[:, center, center, center] > 0).cpu()
+                input_[sensor_] = local_grid.float().to(self.device)
+
+            with torch.no_grad():
+                input_["test_mode"] = True
+                sub_filter_dict = self._filtering(input_)
+                if sub_filter_dict is None:
+                    print("encountered nan in filtering net. Exit")
+                    return
+
+            del input_
+
+            # indices of the kept regions in the scene grid
+            x, y, z = torch.broadcast_tensors(
+                (batch[:, 0:1] * stride + keep).view(n, -1, 1, 1),
+                (batch[:, 1:2] * stride + keep).view(n, 1, -1, 1),
+                (batch[:, 2:3] * stride + keep).view(n, 1, 1, -1),
+            )
+            valid = (x < shape[0]) & (y < shape[1]) & (z < shape[2])
+            x = x[valid].numpy()
+            y = y[valid].numpy()
+            z = z[valid].numpy()
+            observed = observed[valid]
+
+            sensor_weighting = sub_filter_dict["sensor_weighting"].cpu().detach()
+            if self.config.FILTERING_MODEL.CONV3D_MODEL.outlier_channel:
+                sensor_weighting = sensor_weighting.view(
+                    n, 2, chunk_size, chunk_size, chunk_size
+                )
+                sensor_weighting = sensor_weighting[:, :, center, center, center]
+                sensor_weighting = sensor_weighting.transpose(0, 1)[:, valid]
+                sensor_weighting[:, ~observed] = -1
+                database.sensor_weighting[scene][
+                    :, x, y, z
+                ] = sensor_weighting.numpy()
+            else:
+                sensor_weighting = sensor_weighting.view(
+                    n, chunk_size, chunk_size, chunk_size
+                )
+                sensor_weighting = sensor_weighting[:, center, center, center][valid]
+                sensor_weighting[~observed] = -1
+                database.sensor_weighting[scene][x, y, z] = sensor_weighting.numpy()
+
+            sub_tsdf = sub_filter_dict["tsdf"].cpu().detach()
+            sub_tsdf = sub_tsdf.view(n, chunk_size, chunk_size, chunk_size)
+            sub_tsdf = sub_tsdf[:, center, center, center][valid]
+            sub_tsdf[~observed] = self.config.DATA.init_value
+            database.filtered[scene].volume[x, y, z] = sub_tsdf.numpy()
+
+            del sub_filter_dict, sub_tsdf, sensor_weighting
+
     def filter_training(
         self, input_dir, database, epoch, frame, scene_id, sensor, device
     ):
         self.device = device
 
-        indices = input_dir["indices"].cpu()
+        # the integrator returns linear voxel indices
+        indices = unravel_index(
+            input_dir["indices"].cpu().long(), database.scenes_gt[scene_id].shape
+        )
         del input_dir["indices"]
 
         output = self.request_random_bbox(indices, epoch, sensor, frame)
@@ -346,6 +517,7 @@ class Filter_Pipeline(torch.nn.Module):
             bbox = output[0]
             valid_indices = output[1]
 
+        scene_grids = database[scene_id]
         neighborhood = dict()
         neighborhood["test_mode"] = False
         for sensor_ in self.config.DATA.input:
@@ -357,13 +529,13 @@ class Filter_Pipeline(torch.nn.Module):
                     in_dir["features"] = input_dir["features"]
             else:
                 in_dir = {
-                    "tsdf": database[scene_id]["tsdf_" + sensor_],
-                    "weights": database[scene_id]["weights_" + sensor_],
+                    "tsdf": scene_grids["tsdf_" + sensor_],
+                    "weights": scene_grids["weights_" + sensor_],
                 }
                 if (
                     self.config.FILTERING_MODEL.CONV3D_MODEL.features_to_weight_head
                 ):
-                    in_dir["features"] = database[scene_id]["features_" + sensor_]
+                    in_dir["features"] = scene_grids["features_" + sensor_]
 
             neighborhood[sensor_] = self._prepare_input_training(in_dir, bbox, device)
 
@@ -372,7 +544,7 @@ class Filter_Pipeline(torch.nn.Module):
         if tsdf_filtered is None:
             return "save_and_exit"
 
-        gt_vol = database[scene_id]["gt"]
+        gt_vol = scene_grids["gt"]
 
         del neighborhood
 
@@ -388,7 +560,7 @@ class Filter_Pipeline(torch.nn.Module):
             or self.config.LOSS.alpha_single_sensor_supervision
         ):
             if self.config.LOSS.alpha_supervision:
-                proxy_alpha = database[scene_id]["proxy_alpha"]
+                proxy_alpha = scene_grids["proxy_alpha"]
                 # mask target for loss
                 alpha_target = proxy_alpha[
                     bbox[0, 0] : bbox[0, 1],
@@ -510,3 +682,55 @@ class Filter_Pipeline(torch.nn.Module):
             "The desired amount of valid indices were not met or no valid indices were found"
         )
         return None
+
+
+def chunk_occupancy(mask, stride, n_chunks):
+    """Method to find the chunks whose central region contains any voxel of a mask.
+
+    Args:
+        mask: boolean grid aligned with the central region of the first chunk
+        stride: stride between chunks, i.e. the size of the central region
+        n_chunks: number of chunks along each dimension
+
+    Returns:
+        boolean grid of shape n_chunks
+    """
+    padded = np.zeros(tuple(n * stride for n in n_chunks), dtype=bool)
+    padded[: mask.shape[0], : mask.shape[1], : mask.shape[2]] = mask
+
+    return padded.reshape(
+        n_chunks[0], stride, n_chunks[1], stride, n_chunks[2], stride
+    ).any(axis=(1, 3, 5))
+
+
+def dirty_chunks(dirty, block_size, stride, border, n_chunks):
+    """Method to find the chunks whose input window overlaps an updated block.
+
+    Args:
+        dirty: boolean grid of updated blocks
+        block_size: side length of a block in voxels
+        stride: stride between chunks
+        border: border around the kept region of a chunk
+        n_chunks: number of chunks along each dimension
+
+    Returns:
+        (N, 3) chunk indices
+    """
+    overlap = []
+    for axis in range(3):
+        start = torch.arange(n_chunks[axis]) * stride - border
+        end = start + stride + 2 * border
+        blocks = torch.arange(dirty.shape[axis]) * block_size
+        overlap.append(
+            (
+                (blocks[None, :] < end[:, None])
+                & (blocks[None, :] + block_size > start[:, None])
+            ).float()
+        )
+
+    chunks = dirty.float().cpu()
+    chunks = torch.tensordot(overlap[0], chunks, dims=([1], [0]))
+    chunks = torch.tensordot(overlap[1], chunks, dims=([1], [1]))
+    chunks = torch.tensordot(overlap[2], chunks, dims=([1], [2]))
+
+    return chunks.permute(2, 1, 0).nonzero()
@@ -134,6 +134,14 @@ class FilteringNet(nn.Module):
         self.sigmoid = nn.Sigmoid()
         self.softmax = nn.Softmax(dim=1)
 
+    def receptive_radius(self):
+        """Returns the number of voxels an output voxel of the alpha head sees in each direction."""
+        radius = 0
+        for module in self.modules():
+            if isinstance(module, nn.Conv3d):
+                radius += module.dilation[0] * (module.kernel_size[0] - 1) // 2
+        return radius
+
     def forward(self, neighborhood):
         weight = dict()
         sdf = dict()
@@ -172,7 +180,7 @@ class FilteringNet(nn.Module):
                     if self.config.FILTERING_MODEL.CONV3D_MODEL.inverted_weight:
                         weights = torch.ones_like(
                             neighborhood[sensor_][:, 1, :, :, :].unsqueeze(1)
-                        ) - self.tanh(neighborhood[sensor_][:, 1, :, :, :])
+                        ) - self.tanh(neighborhood[sensor_][:, 1, :, :, :]).unsqueeze(1)
                     else:
                         weights = self.tanh(
                             neighborhood[sensor_][:, 1, :, :, :]
@@ -191,9 +199,9 @@ class FilteringNet(nn.Module):
                 input_ = torch.cat((input_, inp), dim=1)
 
             if k == 0:
-                alpha_val[sensor_] = torch.zeros_like(sdf[sensor_])
+                alpha_val[sensor_] = torch.zeros_like(weight[sensor_])
             else:
-                alpha_val[sensor_] = torch.ones_like(sdf[sensor_])
+                alpha_val[sensor_] = torch.ones_like(weight[sensor_])
 
         if input_.isnan().sum() > 0:
             print("Input isnan: ", input_.isnan().sum())
@@ -213,7 +221,7 @@ class FilteringNet(nn.Module):
             output["sensor_weighting"] = alpha.squeeze()
 
         if self.outlier_channel:
-            alpha_sdf = alpha[:, 0, :, :, :]
+            alpha_sdf = alpha[:, 0:1, :, :, :]
         else:
             alpha_sdf = alpha
 
@@ -227,9 +235,9 @@ class FilteringNet(nn.Module):
 
         for k, sensor_ in enumerate(self.config.DATA.input):
             if k == 0:
-                sdf_final = alpha_sdf * sdf[sensor_]
+                sdf_final = alpha_sdf * sdf[sensor_].unsqueeze(1)
             else:
-                sdf_final += (1 - alpha_sdf) * sdf[sensor_]
+                sdf_final += (1 - alpha_sdf) * sdf[sensor_].unsqueeze(1)
 
         output["tsdf"] = sdf_final.squeeze()
 
@@ -1,11 +1,21 @@
 import torch
 
 from modules.routing import ConfidenceRouting
+from modules.routing_cache import RoutingCache
+from modules.routing_cache import checkpoint_hash
 from modules.extractor import Extractor
+from modules.extraction_cache import ExtractionCache
 from modules.model import FusionNet
 from modules.model_features import FeatureNet
 from modules.model_features import FeatureResNet
 from modules.integrator import Integrator
+from modules.integrator import carving_update
+from modules.integrator import merge_updates
+from modules.voxelgrid import crop
+from modules.voxelgrid import global_index
+from modules.voxelgrid import put
+from modules.voxelgrid import take
+from utils.sensors import get_sensor_specs
 
 
 class Fuse_Pipeline(torch.nn.Module):
@@ -41,9 +51,32 @@ class Fuse_Pipeline(torch.nn.Module):
         else:
             self._routing_network = None
 
+        # the routing network is frozen during fusion, so its outputs can be reused
+        if config.ROUTING.do and (
+            config.ROUTING.cache_size > 0 or config.ROUTING.cache_dir
+        ):
+            self._routing_cache = RoutingCache(
+                config.ROUTING.cache_size, config.ROUTING.cache_dir
+            )
+        else:
+            self._routing_cache = None
+        self._routing_checkpoints = dict()
+
         config.FUSION_MODEL.trunc_value = config.DATA.trunc_value
+        config.FUSION_MODEL.block_size = config.DATA.block_size
         config.FUSION_MODEL.init_value = -config.DATA.init_value
 
+        if (
+            config.FUSION_MODEL.empty_space_carving
+            and config.FUSION_MODEL.n_empty_space_voting > 0
+        ):
+            # the carved voxels replace the empty space samples along the rays
+            raise ValueError(
+                "empty_space_carving requires n_empty_space_voting: 0, got {}".format(
+                    config.FUSION_MODEL.n_empty_space_voting
+                )
+            )
+
         config.FEATURE_MODEL.n_points = config.FUSION_MODEL.n_points
         config.FEATURE_MODEL.n_points_tof = config.FUSION_MODEL.n_points_tof
         config.FEATURE_MODEL.n_points_stereo = config.FUSION_MODEL.n_points_stereo
@@ -56,21 +89,40 @@ class Fuse_Pipeline(torch.nn.Module):
 
         self.n_features = self.config.FEATURE_MODEL.n_features
 
+        # sensor specific settings, resolved once instead of per frame
+        self._specs = get_sensor_specs(config.DATA, config.FUSION_MODEL)
+
+        # constant tsdf bands of TSDF Fusion, see _tsdf_template
+        self._tsdf_templates = dict()
+
+        # the ray samples of a frame do not change across epochs since the routing
+        # network is frozen during fusion
+        if config.FUSION_MODEL.extraction_cache:
+            self._extraction_cache = ExtractionCache(
+                config.FUSION_MODEL.extraction_cache_dir,
+                config.FUSION_MODEL.extraction_cache_size,
+            )
+        else:
+            self._extraction_cache = None
+
         self._extractor = dict()
         self._fusion_network = torch.nn.ModuleDict()
         self._feature_network = torch.nn.ModuleDict()
         for sensor in config.DATA.input:
-            self._extractor[sensor] = Extractor(config.FUSION_MODEL, sensor)
+            spec = self._specs[sensor]
+            self._extractor[sensor] = Extractor(
+                config.FUSION_MODEL, spec, self._extraction_cache
+            )
             if config.FUSION_MODEL.use_fusion_net:
-                self._fusion_network[sensor] = FusionNet(config.FUSION_MODEL, sensor)
+                self._fusion_network[sensor] = FusionNet(config.FUSION_MODEL, spec)
             if config.FEATURE_MODEL.use_feature_net:
                 if config.FEATURE_MODEL.network == "resnet":
                     self._feature_network[sensor] = FeatureResNet(
-                        config.FEATURE_MODEL, sensor
+                        config.FEATURE_MODEL, spec
                     )
                 else:
                     self._feature_network[sensor] = FeatureNet(
-                        config.FEATURE_MODEL, sensor
+                        config.FEATURE_MODEL, spec
                     )
             else:
                 self._feature_network[sensor] = None
@@ -78,6 +130,43 @@ class Fuse_Pipeline(torch.nn.Module):
         self._integrator = Integrator(config.FUSION_MODEL)
 
     def _routing(self, data):
+        """Returns the refined depth and confidence of the frames of a batch. With
+        the routing cache, the routing network only runs on the frames that are
+        not cached yet."""
+
+        if self._routing_cache is None:
+            return self._route(data)
+
+        if self.config.FILTERING_MODEL.model == "tsdf_early_fusion":
+            name = "early_fusion"
+            network = self._routing_network
+        else:
+            name = data["routingNet"]
+            network = self._routing_network[name]
+
+        # the weights are hashed once, when the network is first used
+        if name not in self._routing_checkpoints:
+            self._routing_checkpoints[name] = checkpoint_hash(network)
+
+        keys = [
+            (frame_id, name, self._routing_checkpoints[name])
+            for frame_id in data["frame_id"]
+        ]
+        entries = [self._routing_cache.get(key) for key in keys]
+
+        missing = [i for i, entry in enumerate(entries) if entry is None]
+        if missing:
+            frame, confidence = self._route(split_batch(data, missing))
+            for k, i in enumerate(missing):
+                entries[i] = (frame[k], confidence[k])
+                self._routing_cache.put(keys[i], entries[i])
+
+        frame = torch.stack([entry[0].to(self.device) for entry in entries])
+        confidence = torch.stack([entry[1].to(self.device) for entry in entries])
+
+        return frame, confidence
+
+    def _route(self, data):
         if self.config.FILTERING_MODEL.model == "tsdf_early_fusion":
             for k, sensor_ in enumerate(self.config.DATA.input):
                 if k == 0:
@@ -129,6 +218,8 @@ class Fuse_Pipeline(torch.nn.Module):
         fusionNet,
         gt_depth=None,
         extraction_band=11,
+        valid=None,
+        feat_pred=None,
     ):
         output = dict()
         b, c, h, w = input_.shape
@@ -138,46 +229,41 @@ class Fuse_Pipeline(torch.nn.Module):
                     tsdf_pred = self._fusion_network[fusionNet].forward(input_)
             else:
                 tsdf_pred = self._fusion_network[fusionNet].forward(input_)
-        else:  # TSDF Fusion
-            tsdf_pred = torch.zeros(
-                (1, extraction_band, input_.shape[2], input_.shape[3])
+        elif valid is not None:  # TSDF Fusion on the compacted valid rays
+            tsdf_pred = self._tsdf_template(extraction_band, valid.device).expand(
+                -1, int(valid.sum()), -1
             )
-            temp = torch.linspace(
-                (tsdf_pred.shape[1] - 1) / 200,
-                -(tsdf_pred.shape[1] - 1) / 200,
-                steps=tsdf_pred.shape[1],
+        else:  # TSDF Fusion
+            tsdf_pred = self._tsdf_template(extraction_band, input_.device).expand(
+                b, h * w, -1
             )
-            temp = temp.unsqueeze_(0)
-            temp = temp.unsqueeze_(-1)
-            temp = temp.unsqueeze_(-1)
-            try:
-                resolution = eval("self.config.DATA.resx_" + sensor)
-            except AttributeError:
-                resolution = self.config.DATA.resx
 
-            tsdf_pred[:, :, :, :] = temp.expand(-1, -1, resolution, resolution)
-
-        if self.config.FEATURE_MODEL.use_feature_net:
-            feat_pred = self._feature_network[sensor].forward(input_features[sensor])
+        if feat_pred is None:
+            feat_pred = self._predict_features(input_features, sensor)
+
+        n_points = self._specs[sensor].n_points
+
+        if valid is not None:
+            # the feature network sees the full image but only the valid rays are kept
+            tsdf_est = tsdf_pred
+            feature_est = feat_pred.reshape(b, h * w, self.n_features)
+            feature_est = feature_est[valid.view(b, h * w)]
+            feature_est = feature_est.view(1, -1, 1, self.n_features)
+        elif self.config.FUSION_MODEL.use_fusion_net:
+            tsdf_pred = tsdf_pred.permute(0, 2, 3, 1)
+            tsdf_est = tsdf_pred.view(b, h * w, n_points)
+            feature_est = feat_pred.view(b, h * w, 1, self.n_features)
         else:
-            feat_pred = dict()
-            feat_pred["feature"] = input_features[sensor]
+            tsdf_est = tsdf_pred
+            feature_est = feat_pred.view(b, h * w, 1, self.n_features)
 
-        tsdf_pred = tsdf_pred.permute(0, 2, 3, 1)
-
-        feat_pred = feat_pred["feature"].permute(0, 2, 3, 1)
-
-        try:
-            n_points = eval("self.config.FUSION_MODEL.n_points_" + sensor)
-        except AttributeError:
-            n_points = self.config.FUSION_MODEL.n_points
-
-        tsdf_est = tsdf_pred.view(b, h * w, n_points)
-        tsdf_new = torch.clamp(
-            tsdf_est, -self.config.DATA.trunc_value, self.config.DATA.trunc_value
-        )
+        if self.config.FUSION_MODEL.use_fusion_net:
+            tsdf_new = torch.clamp(
+                tsdf_est, -self.config.DATA.trunc_value, self.config.DATA.trunc_value
+            )
+        else:  # the template is already clamped
+            tsdf_new = tsdf_est
 
-        feature_est = feat_pred.view(b, h * w, 1, self.n_features)
         feature_est = feature_est.repeat(1, 1, n_points, 1)
 
         # computing weighted updates for loss calculation
@@ -206,6 +292,39 @@ class Fuse_Pipeline(torch.nn.Module):
 
         return output
 
+    def _tsdf_template(self, n_points, device):
+        """Returns the constant tsdf band used by TSDF Fusion of shape (1, 1, n_points).
+
+        The band only depends on the number of samples along the ray. It is built
+        once per device and broadcast to the rays of the frames with expand.
+        """
+
+        key = (n_points, str(device))
+        if key not in self._tsdf_templates:
+            template = torch.linspace(
+                (n_points - 1) / 200,
+                -(n_points - 1) / 200,
+                steps=n_points,
+                device=device,
+            )
+            template = torch.clamp(
+                template, -self.config.DATA.trunc_value, self.config.DATA.trunc_value
+            )
+            self._tsdf_templates[key] = template.view(1, 1, -1)
+
+        return self._tsdf_templates[key]
+
+    def _predict_features(self, input_features, sensor):
+        """Returns the feature prediction of the frame of shape (b, h, w, n_features)."""
+
+        if self.config.FEATURE_MODEL.use_feature_net:
+            feat_pred = self._feature_network[sensor].forward(input_features[sensor])
+        else:
+            feat_pred = dict()
+            feat_pred["feature"] = input_features[sensor]
+
+        return feat_pred["feature"].permute(0, 2, 3, 1)
+
     def _prepare_fusion_input(
         self,
         frame,
@@ -224,18 +343,12 @@ class Fuse_Pipeline(torch.nn.Module):
         tsdf_input = {}
         tsdf_weights = {}
 
-        tsdf_input[sensor] = values_sensor[sensor]["fusion_values"].view(
-            b, h, w, n_points
-        )
-        tsdf_weights[sensor] = values_sensor[sensor]["fusion_weights"].view(
-            b, h, w, n_points
-        )
-
         tsdf_frame = torch.unsqueeze(frame, -1)
 
         if rgb is not None:
-            rgb = rgb.unsqueeze(-1)
-            rgb = rgb.permute(3, 1, 2, 0)  # never use view here
+            if rgb.dim() == 3:
+                rgb = rgb.unsqueeze(0)
+            rgb = rgb.permute(0, 2, 3, 1)  # never use view here
 
         feature_input = dict()
         feature_input[sensor] = torch.unsqueeze(frame, -1)
@@ -260,6 +373,19 @@ class Fuse_Pipeline(torch.nn.Module):
 
         del rgb
         # stacking input data
+        if values_sensor is None or not self.config.FUSION_MODEL.use_fusion_net:
+            # the tsdf fusion template only needs the frame shape and the extracted
+            # values may be compacted to the valid rays or not extracted yet
+            tsdf_input = tsdf_frame.permute(0, -1, 1, 2)
+            del tsdf_frame
+            return tsdf_input, feature_input
+
+        tsdf_input[sensor] = values_sensor[sensor]["fusion_values"].view(
+            b, h, w, n_points
+        )
+        tsdf_weights[sensor] = values_sensor[sensor]["fusion_weights"].view(
+            b, h, w, n_points
+        )
 
         if self.config.FUSION_MODEL.confidence:
             assert confidence is not None
@@ -282,49 +408,45 @@ class Fuse_Pipeline(torch.nn.Module):
         return tsdf_input, feature_input
 
     def _prepare_volume_update(self, values, est, features, inputs, sensor) -> dict:
+        """Selects the rays of the valid pixels for the integration. When inputs is
+        None, the values are already compacted to the valid rays."""
 
         output = dict()
 
-        try:
-            tail_points = eval("self.config.FUSION_MODEL.n_tail_points_" + sensor)
-        except AttributeError:
-            tail_points = self.config.FUSION_MODEL.n_tail_points
-
-        b, h, w = inputs.shape
-        depth = inputs.view(b, h * w, 1)
-
-        valid = depth != 0.0
-        valid = valid.nonzero()[:, 1]
-
-        valid_filter = inputs[0, :, :].cpu().detach().numpy()
-        valid_filter = valid_filter != 0.0
+        tail_points = self._specs[sensor].n_tail_points
 
-        valid_filter = torch.tensor(valid_filter).unsqueeze(0)
+        update_indices = values["indices"][:, :, :tail_points, :]
+        update_weights = values["weights"][:, :, :tail_points, :]
+        update_values = est[:, :, :tail_points]
+        update_features = features[:, :, :tail_points, :]
 
-        valid_filter = valid_filter.view(b, h * w, 1)
+        if self.config.FUSION_MODEL.n_empty_space_voting > 0:
+            update_indices_empty = values["indices_empty"]
+            update_weights_empty = values["weights_empty"]
 
-        valid_filter = valid_filter.nonzero()[:, 1]
+        if inputs is not None:
+            # gather the rays of the valid pixels of all frames into a single batch
+            b, h, w = inputs.shape
+            valid = inputs.view(b, h * w) != 0.0
 
-        update_indices = values["indices"][:, valid, :tail_points, :, :]
+            update_indices = update_indices[valid].unsqueeze(0)
+            update_weights = update_weights[valid].unsqueeze(0)
+            update_values = update_values[valid].unsqueeze(0)
+            update_features = update_features[valid].unsqueeze(0)
+            if self.config.FUSION_MODEL.n_empty_space_voting > 0:
+                update_indices_empty = update_indices_empty[valid].unsqueeze(0)
+                update_weights_empty = update_weights_empty[valid].unsqueeze(0)
 
-        update_weights = values["weights"][:, valid, :tail_points, :]
+            del valid
 
         if self.config.FUSION_MODEL.n_empty_space_voting > 0:
-            update_indices_empty = values["indices_empty"][:, valid, :, :, :]
-            update_weights_empty = values["weights_empty"][:, valid, :, :]
             output["update_indices_empty"] = update_indices_empty
             output["update_weights_empty"] = update_weights_empty
 
-        update_values = est[:, valid, :tail_points]
-
         update_values = torch.clamp(
             update_values, -self.config.DATA.trunc_value, self.config.DATA.trunc_value
         )
 
-        update_features = features[:, valid, :tail_points, :]
-
-        del valid
-
         # packing
         output["update_values"] = update_values
         output["update_features"] = update_features
@@ -335,6 +457,26 @@ class Fuse_Pipeline(torch.nn.Module):
 
     def fuse(self, batch, database, device):
 
+        # the frames of a batch are fused jointly per scene
+        for scene_batch in split_scenes(batch):
+            self.integrate(self.prepare(scene_batch, device), database, device)
+
+        return
+
+    def prepare(self, batch, device):
+        """Runs the stages of the fusion of a batch that do not depend on the grids,
+        i.e. the routing and the feature network.
+
+        The output is passed to integrate. Since the grids are not touched, the
+        next batch can be prepared while the current one is integrated.
+
+        Args:
+            batch: batch of frames of a single scene and sensor
+            device: compute device
+
+        Returns:
+            dict with the inputs of the integration
+        """
         self.device = device
         # routing
         if self.config.ROUTING.do:
@@ -356,9 +498,10 @@ class Fuse_Pipeline(torch.nn.Module):
         if self.config.FEATURE_MODEL.w_rgb:
             rgb = batch["image"].squeeze().to(device)
         elif self.config.FEATURE_MODEL.w_intensity_gradient:
-            i = batch["intensity"].squeeze()
-            g = batch["gradient"].squeeze()
-            rgb = torch.cat((i, g), dim=0).to(device)
+            # two channels per frame
+            i = batch["intensity"].view(frame.shape).unsqueeze(1)
+            g = batch["gradient"].view(frame.shape).unsqueeze(1)
+            rgb = torch.cat((i, g), dim=1).to(device)
         else:
             rgb = None
 
@@ -371,82 +514,167 @@ class Fuse_Pipeline(torch.nn.Module):
 
         filtered_frame = torch.where(mask == 0, torch.zeros_like(frame), frame)
 
-        # get current tsdf values
-        scene_id = batch["frame_id"][0].split("/")[0]
-
-        extracted_values = dict()
-
         try:
             intrinsics = batch["intrinsics" + "_" + batch["sensor"]]
         except KeyError:
             intrinsics = batch["intrinsics"]
 
-        extracted_values[batch["sensor"]] = self._extractor[batch["sensor"]].forward(
-            frame,
-            batch["extrinsics"],
-            intrinsics,
-            database[scene_id]["tsdf" + "_" + batch["sensor"]],
-            database[scene_id]["features_" + batch["sensor"]],
-            database[scene_id]["origin"],
-            database[scene_id]["resolution"],
-            self.config.SETTINGS.gpu,
-            database[scene_id]["weights" + "_" + batch["sensor"]],
-        )
+        n_points = self._specs[batch["sensor"]].n_points
 
-        try:
-            n_points = eval("self.config.FUSION_MODEL.n_points_" + batch["sensor"])
-        except AttributeError:
-            n_points = self.config.FUSION_MODEL.n_points
-        tsdf_input, feature_input = self._prepare_fusion_input(
+        # the feature prediction only depends on the frame
+        _, feature_input = self._prepare_fusion_input(
             frame,
-            extracted_values,
+            None,
             batch["sensor"],
             confidence,
             n_points,
             rgb,
             rgb_warp,
         )
-        del rgb, frame
+        feat_pred = self._predict_features(feature_input, batch["sensor"])
+        del feature_input
 
-        fusion_output = self._fusion(
-            tsdf_input,
-            feature_input,
-            extracted_values[batch["sensor"]],
-            batch["sensor"],
-            batch["fusionNet"],
-            extraction_band=n_points,
-        )
+        output = dict()
+        output["scene_id"] = batch["frame_id"][0].split("/")[0]
+        output["frame_id"] = batch["frame_id"]
+        output["sensor"] = batch["sensor"]
+        output["fusionNet"] = batch["fusionNet"]
+        output["frame"] = frame
+        output["filtered_frame"] = filtered_frame
+        output["confidence"] = confidence
+        output["rgb"] = rgb
+        output["rgb_warp"] = rgb_warp
+        output["extrinsics"] = batch["extrinsics"]
+        output["intrinsics"] = intrinsics
+        output["n_points"] = n_points
+        output["feat_pred"] = feat_pred
 
-        # masking invalid losses
-        tsdf_est = fusion_output["tsdf_est"]
-        feature_est = fusion_output["feature_est"]
+        return output
 
-        integrator_input = self._prepare_volume_update(
-            extracted_values[batch["sensor"]],
-            tsdf_est,
-            feature_est,
-            filtered_frame,
-            batch["sensor"],
-        )
+    def integrate(self, prepared, database, device):
+        """Extracts the rays of a prepared batch, runs the fusion net if used and
+        integrates the updates into the grids of the scene.
 
-        tsdf, features, weights, indices = self._integrator.forward(
-            integrator_input,
-            database[scene_id]["tsdf_" + batch["sensor"]].to(device),
-            database[scene_id]["features_" + batch["sensor"]].to(device),
-            database[scene_id]["weights_" + batch["sensor"]].to(device),
-        )
+        Args:
+            prepared: output of prepare
+            database: database with the grids
+            device: compute device
+        """
+        scene_id = prepared["scene_id"]
+        sensor = prepared["sensor"]
+        frame = prepared["frame"]
+        filtered_frame = prepared["filtered_frame"]
+        n_points = prepared["n_points"]
+
+        extracted_values = dict()
 
-        del indices, integrator_input
+        scene_grids = database[scene_id]
 
-        database.tsdf[batch["sensor"]][scene_id].volume = tsdf.cpu().detach().numpy()
-        database.fusion_weights[batch["sensor"]][scene_id] = (
-            weights.cpu().detach().numpy()
+        # the fused grids stay on the device for the whole trajectory
+        tsdf_volume = database.get_resident_volume(scene_id, "tsdf_" + sensor, device)
+        features_volume = database.get_resident_volume(
+            scene_id, "features_" + sensor, device
         )
-        database.features[batch["sensor"]][scene_id].volume = (
-            features.cpu().detach().numpy()
+        weights_volume = database.get_resident_volume(
+            scene_id, "weights_" + sensor, device
         )
 
-        del tsdf, weights, features
+        if self.config.FUSION_MODEL.use_fusion_net:
+            # the fusion net needs the extracted values of the full image
+            chunks = [None]
+        else:
+            # only the rays through the valid pixels are extracted and integrated,
+            # optionally in chunks of rays to bound the memory
+            chunks = ray_chunks(
+                filtered_frame != 0.0, self.config.FUSION_MODEL.ray_chunk_size
+            )
+
+        updates = []
+        carved = []
+        band = []
+        for k, valid in enumerate(chunks):
+            extracted_values[sensor] = self._extractor[sensor].forward(
+                frame,
+                prepared["extrinsics"],
+                prepared["intrinsics"],
+                tsdf_volume,
+                features_volume,
+                scene_grids["origin"],
+                scene_grids["resolution"],
+                self.config.SETTINGS.gpu,
+                weights_volume,
+                mask=valid,
+                key=(tuple(prepared["frame_id"]), None if valid is None else k),
+                carve_mask=filtered_frame != 0.0 if valid is None else None,
+            )
+            if self.config.FUSION_MODEL.empty_space_carving:
+                carved.append(extracted_values[sensor].pop("indices_carved"))
+                band.append(extracted_values[sensor].pop("indices_band"))
+
+            tsdf_input, feature_input = self._prepare_fusion_input(
+                frame,
+                extracted_values,
+                sensor,
+                prepared["confidence"],
+                n_points,
+                prepared["rgb"],
+                prepared["rgb_warp"],
+            )
+
+            fusion_output = self._fusion(
+                tsdf_input,
+                feature_input,
+                extracted_values[sensor],
+                sensor,
+                prepared["fusionNet"],
+                extraction_band=n_points,
+                valid=valid,
+                feat_pred=prepared["feat_pred"],
+            )
+            del tsdf_input, feature_input
+
+            # masking invalid losses
+            tsdf_est = fusion_output["tsdf_est"]
+            feature_est = fusion_output["feature_est"]
+
+            integrator_input = self._prepare_volume_update(
+                extracted_values[sensor],
+                tsdf_est,
+                feature_est,
+                filtered_frame if valid is None else None,
+                sensor,
+            )
+            del extracted_values[sensor], fusion_output, tsdf_est, feature_est
+
+            with torch.no_grad():
+                updates.append(self._integrator.reduce(integrator_input))
+            del integrator_input
+
+        del prepared, frame
+
+        update = merge_updates(updates)
+        if carved:
+            # the carved voxels are updated once per frame, also across ray chunks
+            update = merge_updates(
+                [update, carving_update(carved, band, tsdf_volume.shape)]
+            )
+
+        # the grids are updated in place so no autograd history may be attached to them
+        with torch.no_grad():
+            _, _, _, indices, indices_empty = self._integrator.apply(
+                update,
+                tsdf_volume,
+                features_volume,
+                weights_volume,
+            )
+
+        del updates, tsdf_volume, features_volume, weights_volume
+
+        # remember the updated voxels for the incremental filter
+        if self.config.TESTING.filter_refresh > 0:
+            database.mark_dirty(scene_id, indices)
+            if indices_empty is not None:
+                database.mark_dirty(scene_id, indices_empty)
 
         return
 
@@ -479,9 +707,10 @@ class Fuse_Pipeline(torch.nn.Module):
         if self.config.FEATURE_MODEL.w_rgb:
             rgb = batch["image"].squeeze().to(device)
         elif self.config.FEATURE_MODEL.w_intensity_gradient:
-            i = batch["intensity"].squeeze()
-            g = batch["gradient"].squeeze()
-            rgb = torch.cat((i, g), dim=0).to(device)
+            # two channels per frame
+            i = batch["intensity"].view(frame.shape).unsqueeze(1)
+            g = batch["gradient"].view(frame.shape).unsqueeze(1)
+            rgb = torch.cat((i, g), dim=1).to(device)
         else:
             rgb = None
 
@@ -506,37 +735,48 @@ class Fuse_Pipeline(torch.nn.Module):
         except KeyError:
             intrinsics = batch["intrinsics"]
 
+        scene_grids = database[scene_id]
         extracted_values[batch["sensor"]] = self._extractor[batch["sensor"]].forward(
             frame,
             batch["extrinsics"],
             intrinsics,
-            database[scene_id]["tsdf" + "_" + batch["sensor"]],
-            database[scene_id]["features_" + batch["sensor"]],
-            database[scene_id]["origin"],
-            database[scene_id]["resolution"],
+            scene_grids["tsdf" + "_" + batch["sensor"]],
+            scene_grids["features_" + batch["sensor"]],
+            scene_grids["origin"],
+            scene_grids["resolution"],
             self.config.SETTINGS.gpu,
-            database[scene_id]["weights" + "_" + batch["sensor"]],
+            scene_grids["weights" + "_" + batch["sensor"]],
+            key=(tuple(batch["frame_id"]), None),
+            active_region=True,
+            carve_mask=filtered_frame != 0.0,
         )
 
+        # only the region of the grids touched by the frame is moved to the device
+        region = extracted_values[batch["sensor"]]["region"].tolist()
+
+        if self.config.FUSION_MODEL.empty_space_carving:
+            carved = extracted_values[batch["sensor"]].pop("indices_carved")
+            band = extracted_values[batch["sensor"]].pop("indices_band")
+
         extracted_values_gt = self._extractor[batch["sensor"]].forward(
             frame,
             batch["extrinsics"],
             intrinsics,
-            database[scene_id]["gt"],
-            database[scene_id]["features_" + batch["sensor"]],
-            database[scene_id]["origin"],
-            database[scene_id]["resolution"],
+            scene_grids["gt"],
+            scene_grids["features_" + batch["sensor"]],
+            scene_grids["origin"],
+            scene_grids["resolution"],
             self.config.SETTINGS.gpu,
-            database[scene_id]["weights_" + batch["sensor"]],
+            scene_grids["weights_" + batch["sensor"]],
+            key=(tuple(batch["frame_id"]), None),
+            active_region=True,
+            carve_mask=filtered_frame != 0.0,
         )
 
         tsdf_target = extracted_values_gt["fusion_values"]
         del extracted_values_gt
 
-        try:
-            n_points = eval("self.config.FUSION_MODEL.n_points_" + batch["sensor"])
-        except AttributeError:
-            n_points = self.config.FUSION_MODEL.n_points
+        n_points = self._specs[batch["sensor"]].n_points
         tsdf_input, feature_input = self._prepare_fusion_input(
             frame,
             extracted_values,
@@ -587,33 +827,109 @@ class Fuse_Pipeline(torch.nn.Module):
 
         del extracted_values, tsdf_est, feature_est, filtered_frame
 
-        tsdf, features, weights, indices = self._integrator.forward(
-            integrator_input,
-            database[scene_id]["tsdf_" + batch["sensor"]].to(device),
-            database[scene_id]["features_" + batch["sensor"]].to(device),
-            database[scene_id]["weights_" + batch["sensor"]].to(device),
+        tsdf = scene_grids["tsdf_" + batch["sensor"]]
+        features = scene_grids["features_" + batch["sensor"]]
+        weights = scene_grids["weights_" + batch["sensor"]]
+
+        update = self._integrator.reduce(integrator_input)
+        if self.config.FUSION_MODEL.empty_space_carving:
+            shape = tuple(r[1] - r[0] for r in region)
+            update = merge_updates([update, carving_update([carved], [band], shape)])
+
+        # the region is fused in the working precision of the database and written
+        # back to the float16 grids below
+        (
+            tsdf_region,
+            features_region,
+            weights_region,
+            indices,
+            indices_empty,
+        ) = self._integrator.apply(
+            update,
+            database.to_working(crop(tsdf, region), device),
+            database.to_working(crop(features, region), device),
+            database.to_working(crop(weights, region), device),
         )
 
-        del integrator_input
+        del integrator_input, update
 
-        database.tsdf[batch["sensor"]][scene_id].volume = tsdf.cpu().detach().numpy()
-        database.fusion_weights[batch["sensor"]][scene_id] = (
-            weights.cpu().detach().numpy()
-        )
-        database.features[batch["sensor"]][scene_id].volume = (
-            features.cpu().detach().numpy()
+        # write the updated voxels of the region back to the grids. The empty space
+        # updates only change the tsdf and the weights
+        if indices_empty is not None:
+            updated = torch.unique(torch.cat((indices, indices_empty)))
+        else:
+            updated = indices
+        updated_global = global_index(updated, region, tsdf.shape).cpu()
+        put(tsdf, updated_global, take(tsdf_region, updated).cpu())
+        put(weights, updated_global, take(weights_region, updated).cpu())
+        put(
+            features,
+            global_index(indices, region, tsdf.shape).cpu(),
+            take(features_region, indices).cpu(),
         )
 
+        del tsdf_region, features_region, weights_region, updated, updated_global
+
+        database.update_volume(scene_id, "tsdf_" + batch["sensor"], tsdf)
+        database.update_volume(scene_id, "weights_" + batch["sensor"], weights)
+        database.update_volume(scene_id, "features_" + batch["sensor"], features)
+
         output["tsdf"] = tsdf
         output["weights"] = weights
         output["features"] = features
-        output["indices"] = indices
+        output["indices"] = global_index(indices, region, tsdf.shape)
 
         del tsdf, weights, features
 
         return output
 
 
+def split_scenes(batch):
+    """Returns the batches of the frames of each scene in a batch."""
+
+    scenes = [frame_id.split("/")[0] for frame_id in batch["frame_id"]]
+    if len(set(scenes)) == 1:
+        return [batch]
+
+    batches = []
+    for scene_id in sorted(set(scenes), key=scenes.index):
+        frames = [i for i, scene in enumerate(scenes) if scene == scene_id]
+        batches.append(split_batch(batch, frames))
+
+    return batches
+
+
+def split_batch(batch, frames):
+    """Returns the batch of the given frames of a batch."""
+
+    n_frames = len(batch["frame_id"])
+    output = dict()
+    for key, value in batch.items():
+        if torch.is_tensor(value) and value.dim() > 0 and value.shape[0] == n_frames:
+            output[key] = value[frames]
+        elif isinstance(value, list) and len(value) == n_frames:
+            output[key] = [value[i] for i in frames]
+        else:
+            output[key] = value
+
+    return output
+
+
+def ray_chunks(valid, chunk_size):
+    """Splits a boolean pixel mask of shape (b, h, w) into masks with at most
+    chunk_size valid pixels each. A chunk size of 0 yields the mask itself."""
+
+    n_valid = int(valid.sum())
+    if chunk_size <= 0 or n_valid <= chunk_size:
+        yield valid
+        return
+
+    # running index of the valid pixels in row major order
+    rank = torch.cumsum(valid.view(-1).long(), dim=0).view(valid.shape) - 1
+    for start in range(0, n_valid, chunk_size):
+        yield valid & (rank >= start) & (rank < start + chunk_size)
+
+
 def masking(x, values, threshold=0.0, option="ueq"):
 
     if option == "leq":
@@ -1,5 +1,8 @@
 import torch
 
+from modules.voxelgrid import put
+from modules.voxelgrid import take
+
 
 class Integrator(torch.nn.Module):
     def __init__(self, config):
@@ -10,6 +13,7 @@ class Integrator(torch.nn.Module):
         self.max_weight = config.max_weight
         self.extraction_strategy = config.extraction_strategy
         self.n_empty_space_voting = config.n_empty_space_voting
+        self.empty_space_carving = config.empty_space_carving
         self.trunc_value = config.trunc_value
 
     def forward(
@@ -19,12 +23,28 @@ class Integrator(torch.nn.Module):
         features_volume,
         weights_volume,
     ):
-        xs, ys, zs = values_volume.shape
+        update = self.reduce(integrator_input)
+
+        return self.apply(update, values_volume, features_volume, weights_volume)
+
+    def reduce(self, integrator_input):
+        """Aggregates the updates of a set of rays per voxel.
+
+        The partial sums of several ray chunks can be combined with merge_updates
+        before they are applied to the grids.
+
+        Args:
+            integrator_input: update values, features, indices and weights of the rays
 
+        Returns:
+            dict with the sorted int32 linear voxel indices and the summed updates
+        """
         # unpack data
         values = integrator_input["update_values"].to(self.device)
         features = integrator_input["update_features"].to(self.device)
-        indices = integrator_input["update_indices"].to(self.device)
+        indices = integrator_input["update_indices"].to(
+            self.device
+        )  # int32 linear voxel indices, -1 outside of the grid
         weights = integrator_input["update_weights"].to(
             self.device
         )  # update weights. When using nearest neighbor interpolation these are all ones.
@@ -33,234 +53,264 @@ class Integrator(torch.nn.Module):
             indices_empty = integrator_input["update_indices_empty"].to(self.device)
             weights_empty = integrator_input["update_weights_empty"].to(self.device)
 
-        (
-            n1,
-            n2,
-            n3,
-            f4,
-        ) = features.shape
-
-        # reshape tensors
-        features = features.contiguous().view(-1, f4).float()
-        values = values.contiguous().view(-1, 1).float()
-
-        if self.extraction_strategy == "trilinear_interpolation":
-            features = features.repeat(8, 1)
-            values = values.repeat(1, 8)
-            indices = indices.contiguous().view(-1, 8, 3).long()
-            weights = weights.contiguous().view(-1, 8)
-            if self.n_empty_space_voting > 0:
-                indices_empty = indices_empty.contiguous().view(-1, 8, 3).long()
-                weights_empty = weights_empty.contiguous().view(-1, 8)
-        elif self.extraction_strategy == "nearest_neighbor":
-            values = values.repeat(1, 1)
-            indices = indices.contiguous().view(-1, 1, 3).long()
-            weights = weights.contiguous().view(-1, 1)
-            if self.n_empty_space_voting > 0:
-                indices_empty = indices_empty.contiguous().view(-1, 1, 3).long()
-                weights_empty = weights_empty.contiguous().view(-1, 1)
+        k = indices.shape[-1]  # voxels updated per sample, 8 with trilinear splatting
+        f4 = features.shape[-1]
 
+        # reshape tensors to one row per sample
+        index = indices.contiguous().view(-1, k)
+        weights = weights.contiguous().view(-1, k).float()
         values = values.contiguous().view(-1, 1).float()
-        indices = indices.contiguous().view(-1, 3).long()
-
-        if self.n_empty_space_voting > 0:
-            indices_empty = indices_empty.contiguous().view(-1, 3).long()
-            weights_empty = weights_empty.contiguous().view(-1, 1).float()
-
-        weights = weights.contiguous().view(-1, 1).float()
-
-        # get valid indices
-        valid = get_index_mask(indices, values_volume.shape)
-        indices = extract_indices(indices, mask=valid)
-        if self.n_empty_space_voting > 0:
-            valid_empty = get_index_mask(indices_empty, values_volume.shape)
-            indices_empty = extract_indices(indices_empty, mask=valid_empty)
-
-        feature_indices = indices.clone()
-
-        # remove the invalid entries from the values, features and weights
-        valid_features = valid.clone().unsqueeze_(-1)
-        features = torch.masked_select(features, valid_features.repeat(1, f4))
-        features = features.view(int(features.shape[0] / f4), f4)
+        features = features.contiguous().view(-1, f4).float()
+        del indices
+
+        # aggregate the tsdf, weight and feature updates to the same voxel. The
+        # columns are summed as weights * (values, 1, features)
+        output = dict()
+        output["index"], output["update"] = splat(
+            index,
+            weights,
+            torch.cat((values, torch.ones_like(values), features), dim=1),
+        )
+        del values, weights, features
 
-        values = torch.masked_select(values[:, 0], valid)
-        weights = torch.masked_select(weights[:, 0], valid)
         if self.n_empty_space_voting > 0:
-            weights_empty = torch.masked_select(weights_empty[:, 0], valid_empty)
-
-        update_feat = weights.repeat(f4, 1).permute(1, 0) * features
-        del features
-
-        update = weights * values
-        del values
-
-        # aggregate updates to the same index
-
-        # tsdf
-        index = ys * zs * indices[:, 0] + zs * indices[:, 1] + indices[:, 2]
-        indices_insert = torch.unique_consecutive(indices[index.sort()[1]], dim=0)
-        vcache = torch.sparse.FloatTensor(
-            index.unsqueeze_(0), update, torch.Size([xs * ys * zs])
-        ).coalesce()
-        update = vcache.values()
+            # empty space update
+            index_empty = indices_empty.contiguous().view(-1, k)
+            weights_empty = weights_empty.contiguous().view(-1, k).float()
+            del indices_empty
+
+            output["index_empty"], output["update_empty"] = splat(
+                index_empty,
+                weights_empty,
+                torch.ones(
+                    (index_empty.shape[0], 1),
+                    dtype=weights_empty.dtype,
+                    device=weights_empty.device,
+                ),
+            )
 
-        if indices_insert.shape[0] != update.shape[0]:
-            print("wrong dim!")
-        del vcache
+        return output
 
-        # if using the same extraction procedure for fusion and feature updates
-        update_feat_weights = weights
+    def apply(self, update, values_volume, features_volume, weights_volume):
+        """Fuses the aggregated updates into the grids.
 
-        # weights for tsdf
-        wcache = torch.sparse.FloatTensor(
-            index, weights, torch.Size([xs * ys * zs])
-        ).coalesce()  # this line adds the values at the same index together
-        indices = wcache.indices().squeeze()
-        weights = wcache.values()
+        Args:
+            update: aggregated updates from reduce or merge_updates
+            values_volume: tsdf grid
+            features_volume: feature grid
+            weights_volume: weight grid
 
-        del wcache
+        Returns:
+            the grids as well as the linear indices of the updated and the empty
+            space voxels
+        """
+        indices_insert = update["index"]
 
-        if self.n_empty_space_voting > 0:
-            # weights for empty indices
-            index_empty = (
-                ys * zs * indices_empty[:, 0]
-                + zs * indices_empty[:, 1]
-                + indices_empty[:, 2]
-            )
-            indices_empty_insert = torch.unique_consecutive(
-                indices_empty[index_empty.sort()[1]], dim=0
-            )
-            wcache_empty = torch.sparse.FloatTensor(
-                index_empty.unsqueeze_(0), weights_empty, torch.Size([xs * ys * zs])
-            ).coalesce()  # this line adds the values at the same index together
-            indices_empty = wcache_empty.indices().squeeze()
-            weights_empty = wcache_empty.values()
-            del wcache_empty
-
-        # features
-        feature_index = (
-            ys * zs * feature_indices[:, 0]
-            + zs * feature_indices[:, 1]
-            + feature_indices[:, 2]
-        )
-        feature_indices_insert = torch.unique_consecutive(
-            feature_indices[feature_index.sort()[1]], dim=0
-        )
-        fcache = torch.sparse.FloatTensor(
-            feature_index.unsqueeze_(0), update_feat, torch.Size([xs * ys * zs, f4])
-        ).coalesce()
-
-        feature_indices = fcache.indices().squeeze()
-        update_feat = fcache.values()
-        if feature_indices_insert.shape[0] != update_feat.shape[0]:
-            print("wrong dim feat!")
-        del fcache
-
-        # feature weights
-        wcache_feat = torch.sparse.FloatTensor(
-            feature_index, update_feat_weights, torch.Size([xs * ys * zs])
-        ).coalesce()
-        weights_feat = wcache_feat.values().unsqueeze_(-1).repeat(1, f4).float()
-        del wcache_feat
+        update_values = update["update"][:, 0]
+        weights = update["update"][:, 1]
+        update_feat = update["update"][:, 2:]
 
         # tsdf and weights update
-        values_old = values_volume.view(xs * ys * zs)[indices]
-        weights_old = weights_volume.view(xs * ys * zs)[indices]
-        value_update = (weights_old * values_old + update) / (weights_old + weights)
+        values_old = extract_values(indices_insert, values_volume)
+        weights_old = extract_values(indices_insert, weights_volume)
+        value_update = (weights_old * values_old + update_values) / (
+            weights_old + weights
+        )
         weight_update = weights_old + weights
         weight_update = torch.clamp(weight_update, 0, self.max_weight)
 
-        if self.n_empty_space_voting > 0:
-            # empty space update
-            values_old_empty = values_volume.view(xs * ys * zs)[indices_empty]
-            weights_old_empty = weights_volume.view(xs * ys * zs)[indices_empty]
-            value_update_empty = torch.add(
-                weights_old_empty * values_old_empty, self.trunc_value * weights_empty
-            ) / (weights_old_empty + weights_empty)
-            weight_update_empty = weights_old_empty + weights_empty
-            weight_update_empty = torch.clamp(weight_update_empty, 0, self.max_weight)
-
-        # feature update
-        feature_weights_old = (
-            weights_volume.view(xs * ys * zs)[feature_indices]
-            .unsqueeze_(-1)
-            .repeat(1, f4)
-            .float()
+        # feature update. Here we should not multiply update_feat with the weights in the nominator
+        # since we already have that baked in
+        weights_old = weights_old.unsqueeze(-1).float()
+        features_old = extract_values(indices_insert, features_volume)
+        feature_update = (weights_old * features_old + update_feat) / (
+            weights_old + weights.unsqueeze(-1)
         )
 
-        features_old = features_volume.view(xs * ys * zs, f4)[feature_indices]
-
-        # here we should not multiply the update_feat with weights_feat in the nominator since we already have that baked in
-        feature_update = (feature_weights_old * features_old + update_feat) / (
-            feature_weights_old + weights_feat
-        )
+        del update_values, update_feat, values_old, weights_old, features_old
 
-        del update_feat, feature_weights_old, weights_feat
+        if "index_empty" in update and not self.empty_space_carving:
+            (
+                indices_empty_insert,
+                value_update_empty,
+                weight_update_empty,
+            ) = self._empty_space_update(update, values_volume, weights_volume)
 
         # inser tsdf and tsdf weights
         insert_values(value_update, indices_insert, values_volume)
         insert_values(weight_update, indices_insert, weights_volume)
 
         # insert features
-        insert_values(feature_update, feature_indices_insert, features_volume)
+        insert_values(feature_update, indices_insert, features_volume)
+
+        if "index_empty" in update:
+            if self.empty_space_carving:
+                # a voxel carved by one frame of a batch can be in the band of another
+                # frame, so the carved votes are added on top of the surface update
+                (
+                    indices_empty_insert,
+                    value_update_empty,
+                    weight_update_empty,
+                ) = self._empty_space_update(update, values_volume, weights_volume)
 
-        if self.n_empty_space_voting > 0:
             # insert empty tsdf and weights
             insert_values(value_update_empty, indices_empty_insert, values_volume)
             insert_values(weight_update_empty, indices_empty_insert, weights_volume)
+        else:
+            indices_empty_insert = None
 
         return (
             values_volume,
             features_volume,
             weights_volume,
             indices_insert,
+            indices_empty_insert,
         )
 
+    def _empty_space_update(self, update, values_volume, weights_volume):
+        """Computes the tsdf values and weights of the empty space update."""
+        weights_empty = update["update_empty"][:, 0]
+        indices_empty_insert = update["index_empty"]
 
-def get_index_mask(indices, shape):
-    """Method to check whether indices are valid.
+        values_old_empty = extract_values(indices_empty_insert, values_volume)
+        weights_old_empty = extract_values(indices_empty_insert, weights_volume)
+        value_update_empty = torch.add(
+            weights_old_empty * values_old_empty, self.trunc_value * weights_empty
+        ) / (weights_old_empty + weights_empty)
+        weight_update_empty = weights_old_empty + weights_empty
+        weight_update_empty = torch.clamp(weight_update_empty, 0, self.max_weight)
+
+        return indices_empty_insert, value_update_empty, weight_update_empty
+
+
+def merge_updates(updates):
+    """Method to combine the aggregated updates of several ray chunks.
+
+    The partial sums are summed per voxel again, which gives the same result as
+    reducing all rays at once.
+    """
+
+    if len(updates) == 1:
+        return updates[0]
+
+    output = dict()
+    for key in ["index", "index_empty"]:
+        parts = [update for update in updates if key in update]
+        if len(parts) == 0:
+            continue
+        update_key = "update" + key[5:]
+        output[key], output[update_key] = segment_sum(
+            torch.cat([update[key] for update in parts]),
+            torch.cat([update[update_key] for update in parts]),
+        )
+
+    return output
+
+
+def carving_update(carved, band, shape):
+    """Method to build the empty space update of the carved voxels.
+
+    Every voxel traversed by at least one ray of a frame is updated once per frame
+    with weight one, except for the voxels in the band of any ray of the same
+    frame, e.g. next to depth edges or on surfaces seen at a steep angle, which
+    only receive their surface update.
 
     Args:
-        indices: indices to check
-        shape: constraints for indices
+        carved: list of the keys of the carved voxels per frame, e.g. per ray chunk
+        band: list of the keys of the band voxels per frame
+        shape: shape of the grid (or the active region)
 
     Returns:
-        mask
+        dict with the unique sorted int32 indices and their empty space updates
     """
 
-    xs, ys, zs = shape
+    keys = torch.unique(torch.cat(carved), sorted=True)
+    band = torch.unique(torch.cat(band), sorted=True)
+
+    if band.shape[0] > 0:
+        position = torch.searchsorted(band, keys)
+        position = torch.clamp(position, max=band.shape[0] - 1)
+        keys = keys[band[position] != keys]
 
-    valid = (
-        (indices[:, 0] >= 0)
-        & (indices[:, 0] < xs)
-        & (indices[:, 1] >= 0)
-        & (indices[:, 1] < ys)
-        & (indices[:, 2] >= 0)
-        & (indices[:, 2] < zs)
+    # one vote per frame that carved the voxel
+    index = torch.remainder(keys, shape[0] * shape[1] * shape[2])
+    index, update = segment_sum(
+        index.int(), torch.ones((index.shape[0], 1), device=index.device)
     )
 
-    return valid
+    return {"index_empty": index, "update_empty": update}
 
 
-def extract_indices(indices, mask):
-    """Method to extract indices according to mask."""
+def splat(index, weights, values):
+    """Method to sum weighted updates per voxel, where every sample updates the k
+    voxels of its index row, e.g. the 8 corners with trilinear interpolation.
 
-    x = torch.masked_select(indices[:, 0], mask)
-    y = torch.masked_select(indices[:, 1], mask)
-    z = torch.masked_select(indices[:, 2], mask)
+    The weights are applied per voxel during the scatter, so the values of a
+    sample are never replicated k times.
+
+    Args:
+        index: int32 linear voxel indices of shape (N, k), -1 outside of the grid
+        weights: update weights of shape (N, k)
+        values: values of the samples of shape (N, C)
 
-    masked_indices = torch.cat(
-        (x.unsqueeze_(1), y.unsqueeze_(1), z.unsqueeze_(1)), dim=1
+    Returns:
+        unique sorted indices of shape (M,) and the summed weighted values of
+        shape (M, C)
+    """
+
+    unique_index, inverse = torch.unique(index, sorted=True, return_inverse=True)
+    output = torch.zeros(
+        (unique_index.shape[0], values.shape[1]),
+        dtype=values.dtype,
+        device=values.device,
     )
-    return masked_indices
+    for corner in range(index.shape[1]):
+        output.index_add_(
+            0, inverse[:, corner], weights[:, corner : corner + 1] * values
+        )
+
+    # the samples outside of the grid are summed in the row of index -1
+    if unique_index.shape[0] > 0 and unique_index[0] < 0:
+        unique_index = unique_index[1:]
+        output = output[1:]
+
+    return unique_index, output
+
+
+def segment_sum(index, values):
+    """Method to sum all values that share the same linear voxel index.
+
+    The index is sorted once and all value channels are reduced together
+    in a single scatter pass. The cost scales with the number of updates
+    and not with the size of the voxel grid.
+
+    Args:
+        index: linear voxel indices of shape (N,)
+        values: values to aggregate of shape (N, C)
+
+    Returns:
+        unique sorted indices of shape (M,) and the summed values of shape (M, C)
+    """
+
+    unique_index, inverse = torch.unique(index, sorted=True, return_inverse=True)
+    output = torch.zeros(
+        (unique_index.shape[0], values.shape[1]),
+        dtype=values.dtype,
+        device=values.device,
+    )
+    output.index_add_(0, inverse, values)
+
+    return unique_index, output
+
+
+def extract_values(indices, volume):
+    """Method to read the values of a dense or block-sparse volume at linear indices."""
+
+    return take(volume, indices)
 
 
 def insert_values(values, indices, volume):
-    """Method to insert values back into volume."""
-
-    if volume.dim() == 3:
-        volume = volume.half()
-        volume[indices[:, 0], indices[:, 1], indices[:, 2]] = values.half()
-    else:
-        volume = volume.half()
-        volume[indices[:, 0], indices[:, 1], indices[:, 2], :] = values.half()
+    """Method to insert values back into volume. The values are cast to the
+    precision of the volume."""
+
+    put(volume, indices, values)
@@ -4,21 +4,15 @@ from torch import nn
 
 
 class FusionNet(nn.Module):
-    def __init__(self, config, sensor):
+    def __init__(self, config, spec):
 
         super(FusionNet, self).__init__()
 
         self.scale = config.output_scale
         self.conf = config.confidence
 
-        try:
-            self.n_channels = (
-                2 * eval("config.n_points_" + sensor) + 1 + int(config.confidence)
-            )
-            self.n_points = eval("config.n_points_" + sensor)
-        except AttributeError:
-            self.n_channels = 2 * config.n_points + 1 + int(config.confidence)
-            self.n_points = config.n_points
+        self.n_channels = 2 * spec.n_points + 1 + int(config.confidence)
+        self.n_points = spec.n_points
 
         self.block1 = nn.Sequential(
             nn.Conv2d(self.n_channels, self.n_channels, (3, 3), padding=1),
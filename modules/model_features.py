@@ -63,14 +63,12 @@ class DecoderBlock(nn.Module):
 class FeatureNet(nn.Module):
     """Network used in NeuralFusion"""
 
-    def __init__(self, config, sensor):
+    def __init__(self, config, spec):
 
         super(FeatureNet, self).__init__()
 
-        try:
-            self.n_points = eval("config.n_points_" + sensor)
-        except AttributeError:
-            self.n_points = config.n_points
+        sensor = spec.name
+        self.n_points = spec.n_points
 
         self.n_features = config.n_features - config.append_depth
 
@@ -235,14 +233,12 @@ class FeatureNet(nn.Module):
 class FeatureResNet(nn.Module):
     """Residual Network"""
 
-    def __init__(self, config, sensor):
+    def __init__(self, config, spec):
 
         super(FeatureResNet, self).__init__()
 
-        try:
-            self.n_points = eval("config.n_points_" + sensor)
-        except AttributeError:
-            self.n_points = config.n_points
+        sensor = spec.name
+        self.n_points = spec.n_points
 
         self.n_features = config.n_features - config.append_depth
 
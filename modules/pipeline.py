@@ -1,9 +1,16 @@
 import torch
 from tqdm import tqdm
 import math
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 from modules.fuse_pipeline import Fuse_Pipeline
+from modules.fuse_pipeline import split_batch
+from modules.fuse_pipeline import split_scenes
 from modules.filter_pipeline import Filter_Pipeline
+from modules.voxelgrid import dense_slab
 
 import numpy as np
 
@@ -59,52 +66,177 @@ class Pipeline(torch.nn.Module):
 
         return fused_output
 
-    def test(self, loader, dataset, database, sensors, device):
-        for k, batch in tqdm(enumerate(loader), total=len(dataset)):
-            if self.config.DATA.collaborative_reconstruction:
+    def _sensor_executor(self, sensors):
+        """Returns a thread pool to fuse the sensors of a frame concurrently or None."""
+        if (
+            not self.config.TESTING.concurrent_sensors
+            or len(sensors) < 2
+            or self.config.FILTERING_MODEL.model == "routedfusion"
+        ):  # routedfusion fuses all sensors into the same grids
+            return None
+        return ThreadPoolExecutor(max_workers=len(sensors))
+
+    def _map_sensors(self, function, items, executor=None):
+        """Applies function to the per sensor items of a frame. Every sensor only
+        writes to its own grids, so the items are processed concurrently when an
+        executor is given."""
+        if executor is None:
+            return [function(item) for item in items]
+
+        grad = torch.is_grad_enabled()  # the grad mode is local to a thread
+
+        def run(item):
+            with torch.set_grad_enabled(grad):
+                return function(item)
+
+        return list(executor.map(run, items))
+
+    def _prepared_frames(self, loader, sensor_batches, device, executor=None):
+        """Yields the batches of the loader together with the prepared per sensor
+        batches, see Fuse_Pipeline.prepare.
+
+        With TESTING.prefetch_frames > 0, the loading, routing and feature prediction
+        of the next frames run in a background thread while the current frame is
+        integrated. The frames are yielded in the order of the loader.
+        """
+
+        def prepare(batch):
+            batches = [
+                scene_batch
+                for sensor_batch in sensor_batches(batch)
+                for scene_batch in split_scenes(sensor_batch)
+            ]
+            prepare_batch = partial(self.fuse_pipeline.prepare, device=device)
+            return batch, self._map_sensors(prepare_batch, batches, executor)
+
+        if self.config.TESTING.prefetch_frames > 0:
+            return prefetch(loader, prepare, self.config.TESTING.prefetch_frames)
+        return map(prepare, loader)
+
+    def _sensor_batches(self, batch, sensors):
+        """Returns the per sensor batches of a frame for the test method."""
+        if self.config.DATA.collaborative_reconstruction:
+            # every frame is fused by the sensor of its chunk of frames
+            frame_sensors = []
+            for frame_id in batch["frame_id"]:
                 if (
                     math.ceil(
-                        int(batch["frame_id"][0].split("/")[-1])
-                        / self.config.DATA.frames_per_chunk
+                        int(frame_id.split("/")[-1]) / self.config.DATA.frames_per_chunk
                     )
                     % 2
                     == 0
                 ):
-                    sensor_ = sensors[0]
+                    frame_sensors.append(sensors[0])
                 else:
-                    sensor_ = sensors[1]
+                    frame_sensors.append(sensors[1])
 
-                batch["depth"] = batch[sensor_ + "_depth"]
-                batch["routing_net"] = "self._routing_network_" + sensor_
-                batch["mask"] = batch[sensor_ + "_mask"]
+        sensor_batches = []
+        for sensor_ in sensors:
+            if self.config.DATA.collaborative_reconstruction:
+                frames = [k for k, s in enumerate(frame_sensors) if s == sensor_]
+                if frames:
+                    sensor_batch = split_batch(batch, frames)
+                    sensor_batch["depth"] = sensor_batch[sensor_ + "_depth"]
+                    sensor_batch["routing_net"] = "self._routing_network_" + sensor_
+                    sensor_batch["mask"] = sensor_batch[sensor_ + "_mask"]
+                    if self.config.FILTERING_MODEL.model == "routedfusion":
+                        sensor_batch["sensor"] = self.config.DATA.input[0]
+                    else:
+                        sensor_batch["sensor"] = sensor_
+
+                    sensor_batch["routingNet"] = sensor_
+                    sensor_batch["fusionNet"] = sensor_
+                    sensor_batches.append(sensor_batch)
+            elif (
+                sensor_ + "_depth"
+            ) in batch:  # None on the Replica dataset when simulating sensors of different frame rates
+                # shallow copy since the sensors may be fused concurrently
+                sensor_batch = dict(batch)
+                sensor_batch["depth"] = batch[sensor_ + "_depth"]
+                sensor_batch["routing_net"] = "self._routing_network_" + sensor_
+                sensor_batch["mask"] = batch[sensor_ + "_mask"]
                 if self.config.FILTERING_MODEL.model == "routedfusion":
-                    batch["sensor"] = self.config.DATA.input[0]
+                    sensor_batch["sensor"] = self.config.DATA.input[0]
                 else:
-                    batch["sensor"] = sensor_
+                    sensor_batch["sensor"] = sensor_
 
-                batch["routingNet"] = sensor_  # used to be able to train routedfusion
-                batch["fusionNet"] = sensor_  # used to be able to train routedfusion
-                self.fuse_pipeline.fuse(batch, database, device)
-            else:
-                for sensor_ in sensors:
-                    if (
-                        sensor_ + "_depth"
-                    ) in batch:  # None on the Replica dataset when simulating sensors of different frame rates
-                        batch["depth"] = batch[sensor_ + "_depth"]
-                        batch["routing_net"] = "self._routing_network_" + sensor_
-                        batch["mask"] = batch[sensor_ + "_mask"]
-                        if self.config.FILTERING_MODEL.model == "routedfusion":
-                            batch["sensor"] = self.config.DATA.input[0]
-                        else:
-                            batch["sensor"] = sensor_
-
-                        batch[
-                            "routingNet"
-                        ] = sensor_  # used to be able to train routedfusion
-                        batch[
-                            "fusionNet"
-                        ] = sensor_  # used to be able to train routedfusion
-                        self.fuse_pipeline.fuse(batch, database, device)
+                sensor_batch[
+                    "routingNet"
+                ] = sensor_  # used to be able to train routedfusion
+                sensor_batch[
+                    "fusionNet"
+                ] = sensor_  # used to be able to train routedfusion
+                sensor_batches.append(sensor_batch)
+
+        return sensor_batches
+
+    def _tsdf_sensor_batches(self, batch, sensors):
+        """Returns the per sensor batches of a frame for the test_tsdf method."""
+        if (
+            self.config.ROUTING.do
+            and self.config.FILTERING_MODEL.model == "tsdf_early_fusion"
+        ):
+            batch["routing_net"] = "self._routing_network"
+            batch["sensor"] = self.config.DATA.input[0]
+            batch["fusionNet"] = None  # We don't use a fusion net during early fusion
+            return [batch]
+
+        sensor_batches = []
+        for sensor_ in sensors:
+            # shallow copy since the sensors may be fused concurrently
+            sensor_batch = dict(batch)
+            sensor_batch["depth"] = batch[sensor_ + "_depth"]
+            sensor_batch["routing_net"] = "self._routing_network_" + sensor_
+            sensor_batch["mask"] = batch[sensor_ + "_mask"]
+            sensor_batch["sensor"] = sensor_
+            sensor_batch[
+                "routingNet"
+            ] = sensor_  # used to be able to train routedfusion
+            sensor_batch["fusionNet"] = sensor_  # used to be able to train routedfusion
+            sensor_batches.append(sensor_batch)
+
+        return sensor_batches
+
+    def _release_scenes(self, batch, database):
+        """Writes the resident grids of the scenes that are not in the batch back to
+        the database, such that only the grids of the current scenes are resident."""
+        scenes = [frame_id.split("/")[0] for frame_id in batch["frame_id"]]
+        for scene in list(database.resident.keys()):
+            if scene not in scenes:
+                database.sync(scene)
+
+    def test(self, loader, dataset, database, sensors, device):
+        executor = self._sensor_executor(sensors)
+        frames = self._prepared_frames(
+            loader, partial(self._sensor_batches, sensors=sensors), device, executor
+        )
+        integrate = partial(
+            self.fuse_pipeline.integrate, database=database, device=device
+        )
+        refresh = self.config.TESTING.filter_refresh
+        n_frames = 0
+        for k, (batch, prepared) in tqdm(enumerate(frames), total=len(dataset)):
+            self._release_scenes(batch, database)
+            self._map_sensors(integrate, prepared, executor)
+
+            # the refresh interval counts frames, a batch may hold several
+            n_batch = len(batch["frame_id"])
+            n_frames += n_batch
+            if (
+                self.filter_pipeline is not None
+                and refresh > 0
+                and n_frames // refresh > (n_frames - n_batch) // refresh
+            ):
+                # live refresh of the chunks that changed since the last refresh
+                scenes = [frame_id.split("/")[0] for frame_id in batch["frame_id"]]
+                for scene in sorted(set(scenes), key=scenes.index):
+                    self.filter_pipeline.filter_incremental(scene, database, device)
+
+        if executor is not None:
+            executor.shutdown()
+
+        # write the device resident grids back to the database
+        database.sync()
 
         if self.filter_pipeline is not None:
             # run filtering network on all voxels which have a non-zero weight
@@ -112,62 +244,122 @@ class Pipeline(torch.nn.Module):
                 self.filter_pipeline.filter(scene, database, device)
 
     def test_tsdf(self, val_loader, val_dataset, val_database, sensors, device):
+        executor = self._sensor_executor(sensors)
+        frames = self._prepared_frames(
+            val_loader,
+            partial(self._tsdf_sensor_batches, sensors=sensors),
+            device,
+            executor,
+        )
+        integrate = partial(
+            self.fuse_pipeline.integrate, database=val_database, device=device
+        )
+        for k, (batch, prepared) in tqdm(enumerate(frames), total=len(val_dataset)):
+            self._release_scenes(batch, val_database)
+            self._map_sensors(integrate, prepared, executor)
 
-        for k, batch in tqdm(enumerate(val_loader), total=len(val_dataset)):
+        if executor is not None:
+            executor.shutdown()
 
-            if (
-                self.config.ROUTING.do
-                and self.config.FILTERING_MODEL.model == "tsdf_early_fusion"
-            ):
-                batch["routing_net"] = "self._routing_network"
-                batch["sensor"] = self.config.DATA.input[0]
-                batch[
-                    "fusionNet"
-                ] = None  # We don't use a fusion net during early fusion
-                self.fuse_pipeline.fuse(batch, val_database, device)
-            else:
-                for sensor_ in sensors:
-                    batch["depth"] = batch[sensor_ + "_depth"]
-                    batch["routing_net"] = "self._routing_network_" + sensor_
-                    batch["mask"] = batch[sensor_ + "_mask"]
-                    batch["sensor"] = sensor_
-                    batch[
-                        "routingNet"
-                    ] = sensor_  # used to be able to train routedfusion
-                    batch[
-                        "fusionNet"
-                    ] = sensor_  # used to be able to train routedfusion
-                    self.fuse_pipeline.fuse(batch, val_database, device)
+        # write the device resident grids back to the database
+        val_database.sync()
 
         if self.config.FILTERING_MODEL.do:
-            # perform the fusion of the grids
+            # perform the fusion of the grids. The grids are fused in slabs of
+            # block_size planes and written into the filtered and sensor weighting
+            # grids, which may be memory mapped
+            slab = self.config.DATA.block_size
             if self.config.FILTERING_MODEL.model == "tsdf_early_fusion":
                 for scene in val_database.filtered.keys():
-                    val_database.filtered[scene].volume = val_database.tsdf[
-                        self.config.DATA.input[0]
-                    ][scene].volume
+                    filtered = val_database.filtered[scene].volume
+                    tsdf = val_database.tsdf[self.config.DATA.input[0]][scene].volume
+                    # copied since the grids are reset separately
+                    for x in range(0, filtered.shape[0], slab):
+                        filtered[x : x + slab] = dense_slab(tsdf, x, x + slab)
 
             elif (
                 self.config.FILTERING_MODEL.model == "tsdf_middle_fusion"
             ):  # this is weighted average fusion
                 for scene in val_database.filtered.keys():
-                    weight_sum = np.zeros_like(val_database.filtered[scene].volume)
-                    for sensor_ in sensors:
-                        weight_sum += val_database.fusion_weights[sensor_][scene]
-                        val_database.filtered[scene].volume += (
-                            val_database.tsdf[sensor_][scene].volume
-                            * val_database.fusion_weights[sensor_][scene]
+                    filtered = val_database.filtered[scene].volume
+                    sensor_weighting = val_database.sensor_weighting[scene]
+                    for x in range(0, filtered.shape[0], slab):
+                        values = np.array(filtered[x : x + slab])
+                        weight_sum = np.zeros_like(values)
+                        for sensor_ in sensors:
+                            fusion_weights = dense_slab(
+                                val_database.fusion_weights[sensor_][scene], x, x + slab
+                            )
+                            tsdf = dense_slab(
+                                val_database.tsdf[sensor_][scene].volume, x, x + slab
+                            )
+                            weight_sum += fusion_weights
+                            values += tsdf * fusion_weights
+                        filtered[x : x + slab] = np.divide(
+                            values,
+                            weight_sum,
+                            out=np.zeros_like(weight_sum),
+                            where=weight_sum != 0.0,
                         )
-                    val_database.filtered[scene].volume = np.divide(
-                        val_database.filtered[scene].volume,
-                        weight_sum,
-                        out=np.zeros_like(weight_sum),
-                        where=weight_sum != 0.0,
-                    )
 
-                    val_database.sensor_weighting[scene] = np.divide(
-                        val_database.fusion_weights[sensors[0]][scene],
-                        weight_sum,
-                        out=np.zeros_like(weight_sum),
-                        where=weight_sum != 0.0,
-                    )
+                        sensor_weighting[..., x : x + slab, :, :] = np.divide(
+                            dense_slab(
+                                val_database.fusion_weights[sensors[0]][scene],
+                                x,
+                                x + slab,
+                            ),
+                            weight_sum,
+                            out=np.zeros_like(weight_sum),
+                            where=weight_sum != 0.0,
+                        )
+
+
+def prefetch(iterable, function, size):
+    """Yields function(item) for the items of iterable in order. The results are
+    computed in a background thread, at most size items ahead of the consumer."""
+
+    results = queue.Queue(maxsize=size)
+    end = object()
+    stop = threading.Event()  # set when the consumer stops early
+    grad = torch.is_grad_enabled()  # the grad mode is local to a thread
+
+    def send(value):
+        while not stop.is_set():
+            try:
+                results.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            with torch.set_grad_enabled(grad):
+                for item in iterable:
+                    if stop.is_set() or not send(function(item)):
+                        return
+        except BaseException as error:  # raised again in the consuming thread
+            send(error)
+        finally:
+            send(end)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            result = results.get()
+            if result is end:
+                break
+            if isinstance(result, BaseException):
+                raise result
+            yield result
+    finally:
+        # release the producer and the prefetched results
+        stop.set()
+        while thread.is_alive() or not results.empty():
+            try:
+                results.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        thread.join()
@@ -0,0 +1,85 @@
+import hashlib
+import os
+import threading
+
+from collections import OrderedDict
+
+import torch
+
+
+class RoutingCache:
+    """LRU cache of the outputs of a frozen routing network.
+
+    The entries are keyed by (frame_id, routing network, checkpoint hash) such that
+    the outputs of different checkpoints are never mixed. The entries are kept on
+    the cpu. With a directory, every entry is also stored on disk and entries that
+    are not in memory are reloaded from there, also across runs.
+    """
+
+    def __init__(self, size, directory=None):
+
+        self.size = size
+        self.directory = directory or None
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached (depth, confidence) of a key or None."""
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        if self.directory is None:
+            return None
+
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+
+        entry = torch.load(path)
+        self._insert(key, entry)
+
+        return entry
+
+    def put(self, key, entry):
+        """Caches the (depth, confidence) of a key."""
+
+        # copies, since views of the batch output would keep the whole batch alive
+        entry = tuple(x.detach().cpu().clone() for x in entry)
+        self._insert(key, entry)
+
+        if self.directory is not None:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write to a temporary file first such that readers never see partial files
+            torch.save(entry, path + ".tmp")
+            os.replace(path + ".tmp", path)
+
+    def _insert(self, key, entry):
+
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def _path(self, key):
+
+        frame_id, network, checkpoint = key
+
+        return os.path.join(self.directory, checkpoint, network, frame_id + ".pt")
+
+
+def checkpoint_hash(network):
+    """Returns a short hash of the weights of a network."""
+
+    digest = hashlib.sha1()
+    state_dict = network.state_dict()
+    for name in sorted(state_dict.keys()):
+        digest.update(name.encode())
+        digest.update(state_dict[name].detach().cpu().numpy().tobytes())
+
+    return digest.hexdigest()[:16]
@@ -1,14 +1,17 @@
 import numpy as np
 import math
+import torch
 
 
 class FeatureGrid(object):
-    def __init__(self, voxel_size, n_features, bbox=None):
+    def __init__(
+        self, voxel_size, n_features, bbox=None, block_size=None, volume=None
+    ):
 
         self._resolution = voxel_size
         self._bbox = bbox
         self._n_features = n_features
-        self._volume = None
+        self._volume = volume
 
         if bbox is not None:
             self._origin = bbox[:, 0]
@@ -23,7 +26,10 @@ class FeatureGrid(object):
                 .tolist()
             )  # round up
 
-            self._volume = np.zeros(self._shape, dtype=np.float16)
+            if volume is None and block_size:
+                self._volume = BlockGrid(self._shape, block_size)
+            elif volume is None:
+                self._volume = np.zeros(self._shape, dtype=np.float16)
 
     @property
     def resolution(self):
@@ -58,7 +64,9 @@ class FeatureGrid(object):
 
 
 class VoxelGrid(object):
-    def __init__(self, voxel_size, volume=None, bbox=None, initial_value=0.0):
+    def __init__(
+        self, voxel_size, volume=None, bbox=None, initial_value=0.0, block_size=None
+    ):
 
         self._resolution = voxel_size
 
@@ -75,8 +83,11 @@ class VoxelGrid(object):
             volume_shape = volume_shape.astype(np.float16)
 
             volume_shape = np.ceil(volume_shape).astype(np.int32).tolist()  # round up
-            # float 16 conversion is critical
-            self._volume = initial_value * np.ones(volume_shape).astype("float16")
+            if block_size:
+                self._volume = BlockGrid(volume_shape, block_size, initial_value)
+            else:
+                # float 16 conversion is critical
+                self._volume = initial_value * np.ones(volume_shape).astype("float16")
 
     def from_array(self, array, bbox):
 
@@ -114,3 +125,346 @@ class VoxelGrid(object):
 
     def __getattr__(self, x, y, z):
         return self._volume[x, y, z]
+
+
+class BlockGrid(object):
+    """Block-sparse voxel volume.
+
+    The volume is split into bricks of block_size^3 voxels which are only
+    allocated once a value is written into them. Reading an unallocated voxel
+    returns the initial value. The grid supports the indexing used on the dense
+    volumes: gathering and scattering with (x, y, z) index tensors and reading
+    dense crops with slices.
+    """
+
+    def __init__(
+        self,
+        shape,
+        block_size=8,
+        initial_value=0.0,
+        dtype=torch.float16,
+        device="cpu",
+    ):
+
+        self._shape = tuple(int(s) for s in shape)
+        self.block_size = block_size
+        self.initial_value = initial_value
+        self.n_blocks = 0
+
+        table_shape = tuple(int(math.ceil(s / block_size)) for s in self._shape[:3])
+        # maps a block coordinate to its slot in the pool, -1 if not allocated
+        self.table = -torch.ones(table_shape, dtype=torch.long, device=device)
+        self.coords = torch.zeros((0, 3), dtype=torch.long, device=device)
+        self.pool = torch.zeros(
+            (0, block_size, block_size, block_size) + self._shape[3:],
+            dtype=dtype,
+            device=device,
+        )
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def dtype(self):
+        return self.pool.dtype
+
+    @property
+    def device(self):
+        return self.pool.device
+
+    def dim(self):
+        return len(self._shape)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        if all(isinstance(k, slice) for k in key):
+            return self._crop(key)
+
+        return self._gather(key[0], key[1], key[2])
+
+    def __setitem__(self, key, values):
+        x, y, z = key[:3]
+        b = self.block_size
+        slots = self._allocate(x // b, y // b, z // b)
+        self.pool[slots, x % b, y % b, z % b] = values.to(self.pool.dtype)
+
+    def _gather(self, x, y, z):
+        """Method to read the voxels at the given indices."""
+        x, y, z = torch.broadcast_tensors(x, y, z)
+        b = self.block_size
+        slots = self.table[x // b, y // b, z // b]
+        allocated = slots >= 0
+
+        output = torch.full(
+            tuple(x.shape) + self._shape[3:],
+            self.initial_value,
+            dtype=self.pool.dtype,
+            device=self.pool.device,
+        )
+        output[allocated] = self.pool[
+            slots[allocated],
+            x[allocated] % b,
+            y[allocated] % b,
+            z[allocated] % b,
+        ]
+
+        return output
+
+    def _crop(self, key):
+        """Method to read a dense crop of the volume given by slices."""
+        ranges = []
+        for k, s in zip(key[:3], self._shape[:3]):
+            start, stop, step = k.indices(s)
+            ranges.append(torch.arange(start, stop, step, device=self.pool.device))
+
+        x, y, z = torch.meshgrid(ranges)
+        output = self._gather(x.reshape(-1), y.reshape(-1), z.reshape(-1))
+        output = output.view(tuple(x.shape) + self._shape[3:])
+        if len(key) > 3:
+            output = output[..., key[3]]
+
+        return output
+
+    def _allocate(self, bx, by, bz):
+        """Method to allocate the bricks at the given block coordinates.
+
+        Returns:
+            pool slots of the bricks
+        """
+        slots = self.table[bx, by, bz]
+        missing = slots < 0
+        if not missing.any():
+            return slots
+
+        blocks = torch.stack((bx[missing], by[missing], bz[missing]), dim=1)
+        blocks = torch.unique(blocks, dim=0)
+        n_blocks = self.n_blocks + blocks.shape[0]
+
+        if n_blocks > self.pool.shape[0]:
+            # grow the pool geometrically to amortize the reallocation
+            capacity = max(2 * self.pool.shape[0], n_blocks)
+            pool = torch.full(
+                (capacity,) + tuple(self.pool.shape[1:]),
+                self.initial_value,
+                dtype=self.pool.dtype,
+                device=self.pool.device,
+            )
+            pool[: self.n_blocks] = self.pool[: self.n_blocks]
+            coords = torch.zeros(
+                (capacity, 3), dtype=torch.long, device=self.pool.device
+            )
+            coords[: self.n_blocks] = self.coords[: self.n_blocks]
+            self.pool = pool
+            self.coords = coords
+
+        new_slots = torch.arange(self.n_blocks, n_blocks, device=self.pool.device)
+        self.table[blocks[:, 0], blocks[:, 1], blocks[:, 2]] = new_slots
+        self.coords[new_slots] = blocks
+        self.n_blocks = n_blocks
+
+        return self.table[bx, by, bz]
+
+    def _replace(self, pool, table, coords):
+        # the block table and coordinates are copied since the grids allocate
+        # their bricks independently
+        grid = BlockGrid.__new__(BlockGrid)
+        grid.__dict__.update(self.__dict__)
+        grid.pool = pool
+        grid.table = table.clone() if table is self.table else table
+        grid.coords = coords.clone() if coords is self.coords else coords
+        return grid
+
+    def to(self, device):
+        pool = self.pool.to(device)
+        if pool is self.pool:
+            return self
+        return self._replace(pool, self.table.to(device), self.coords.to(device))
+
+    def cuda(self):
+        return self.to("cuda")
+
+    def cpu(self):
+        return self.to("cpu")
+
+    def half(self):
+        if self.pool.dtype == torch.float16:
+            return self
+        return self._replace(self.pool.half(), self.table, self.coords)
+
+    def float(self):
+        if self.pool.dtype == torch.float32:
+            return self
+        return self._replace(self.pool.float(), self.table, self.coords)
+
+    def detach(self):
+        return self._replace(self.pool.detach(), self.table, self.coords)
+
+    def blocks(self):
+        """Returns the block coordinates and bricks of all allocated blocks."""
+        return self.coords[: self.n_blocks], self.pool[: self.n_blocks]
+
+    def to_dense(self):
+        """Returns the volume as a dense tensor."""
+        b = self.block_size
+        gx, gy, gz = self.table.shape
+        features = self._shape[3:]
+
+        dense = torch.full(
+            (gx * b, gy * b, gz * b) + features,
+            self.initial_value,
+            dtype=self.pool.dtype,
+            device=self.pool.device,
+        )
+        if self.n_blocks > 0:
+            bricks = dense.view((gx, b, gy, b, gz, b) + features)
+            bricks = bricks.permute(
+                (0, 2, 4, 1, 3, 5) + tuple(range(6, 6 + len(features)))
+            )
+            coords, pool = self.blocks()
+            bricks[coords[:, 0], coords[:, 1], coords[:, 2]] = pool
+
+        return dense[: self._shape[0], : self._shape[1], : self._shape[2]]
+
+    def numpy(self):
+        """Returns the volume as a dense numpy array."""
+        return self.to_dense().detach().cpu().numpy()
+
+
+def to_numpy(volume):
+    """Method to get a dense numpy array from a dense or block-sparse volume."""
+    if isinstance(volume, BlockGrid):
+        return volume.numpy()
+    return volume
+
+
+def dense_slab(volume, start, stop):
+    """Method to read the dense numpy slab volume[start:stop] along the first axis of
+    a dense or block-sparse volume."""
+    if isinstance(volume, BlockGrid):
+        return volume[start:stop, :, :].cpu().numpy()
+    return np.asarray(volume[start:stop])
+
+
+def occupied_voxels(volume):
+    """Method to get the (N, 3) indices of the voxels with positive values, e.g. the
+    observed voxels of a weight grid. Only the allocated bricks of a block-sparse
+    volume are visited."""
+    if not isinstance(volume, BlockGrid):
+        return np.argwhere(np.asarray(volume) > 0)
+
+    coords, pool = volume.blocks()
+    slot, x, y, z = torch.nonzero(pool > 0, as_tuple=True)
+    voxels = coords[slot] * volume.block_size + torch.stack((x, y, z), dim=1)
+
+    return voxels.cpu().numpy()
+
+
+def occupancy(volume):
+    """Method to get the boolean mask of the voxels with positive values without a
+    dense copy of a block-sparse volume."""
+    if not isinstance(volume, BlockGrid):
+        return np.asarray(volume) > 0
+
+    mask = np.zeros(volume.shape, dtype=bool)
+    voxels = occupied_voxels(volume)
+    mask[voxels[:, 0], voxels[:, 1], voxels[:, 2]] = True
+
+    return mask
+
+
+def voxel_values(volume, voxels):
+    """Method to read the voxels at (N, 3) indices of a dense or block-sparse volume."""
+    if isinstance(volume, BlockGrid):
+        index = torch.from_numpy(voxels).to(volume.device)
+        return volume[index[:, 0], index[:, 1], index[:, 2]].cpu().numpy()
+
+    return volume[voxels[:, 0], voxels[:, 1], voxels[:, 2]]
+
+
+def ravel_index(indices, shape):
+    """Method to convert (N, 3) voxel indices to int32 linear voxel indices."""
+    xs, ys, zs = shape[:3]
+    if xs * ys * zs > torch.iinfo(torch.int32).max:
+        raise ValueError("The grid is too large for int32 linear voxel indices")
+
+    index = ys * zs * indices[:, 0] + zs * indices[:, 1] + indices[:, 2]
+
+    return index.int()
+
+
+def unravel_index(index, shape):
+    """Method to convert linear voxel indices to (N, 3) voxel indices."""
+    xs, ys, zs = shape[:3]
+
+    x = index // (ys * zs)
+    y = (index // zs) % ys
+    z = index % zs
+
+    return torch.stack((x, y, z), dim=1)
+
+
+def take(volume, index):
+    """Method to read a dense or block-sparse volume at linear voxel indices."""
+    if isinstance(volume, BlockGrid):
+        indices = unravel_index(index.long(), volume.shape)
+        return volume[indices[:, 0], indices[:, 1], indices[:, 2]]
+    return volume.view((-1,) + tuple(volume.shape[3:]))[index.long()]
+
+
+def put(volume, index, values):
+    """Method to write values into a dense or block-sparse volume at linear voxel indices."""
+    if isinstance(volume, BlockGrid):
+        indices = unravel_index(index.long(), volume.shape)
+        volume[indices[:, 0], indices[:, 1], indices[:, 2]] = values
+    else:
+        volume.view((-1,) + tuple(volume.shape[3:]))[index.long()] = values.to(
+            volume.dtype
+        )
+
+
+def get_active_region(points, shape, block_size=1):
+    """Method to compute the block aligned region of a volume that contains all voxels
+    touched by a set of sample points.
+
+    Args:
+        points: floating point voxel coordinates of shape (N, 3)
+        shape: shape of the volume
+        block_size: the region is aligned to blocks of this size
+
+    Returns:
+        region as a list of [start, stop] per axis
+    """
+    region = []
+    for axis in range(3):
+        if points.shape[0] == 0:
+            region.append([0, 0])
+            continue
+
+        # the samples touch the voxels floor(p) and floor(p) + 1 at most
+        start = int(torch.floor(points[:, axis].min()))
+        stop = int(torch.floor(points[:, axis].max())) + 2
+
+        start = min(max(start // block_size * block_size, 0), shape[axis])
+        stop = min(-(-stop // block_size) * block_size, shape[axis])
+        region.append([start, max(start, stop)])
+
+    return region
+
+
+def crop(volume, region):
+    """Method to read the dense crop of a dense or block-sparse volume given by a region."""
+    (x0, x1), (y0, y1), (z0, z1) = region
+
+    return volume[x0:x1, y0:y1, z0:z1].contiguous()
+
+
+def global_index(index, region, shape):
+    """Method to convert linear voxel indices within a region of a volume to linear
+    voxel indices of the volume."""
+    offset = torch.tensor([r[0] for r in region], device=index.device)
+    local_shape = [r[1] - r[0] for r in region]
+
+    return ravel_index(unravel_index(index.long(), local_shape) + offset, shape)
@@ -62,6 +62,9 @@ def test_fusion(config):
         device = torch.device("cpu")
     config.FUSION_MODEL.device = device
 
+    # every frame is only fused once, so cached ray samples would never be reused
+    config.FUSION_MODEL.extraction_cache = False
+
     # get test dataset
     data_config = setup.get_data_config(config, mode="test")
     dataset = setup.get_data(config.DATA.dataset, data_config)
@@ -144,7 +144,7 @@ def train_fusion(args):
         else:
             for sensor_ in config.DATA.input:
                 checkpoint = torch.load(
-                    eval("config.TRAINING.routing_" + sensor_ + "_model_path")
+                    getattr(config.TRAINING, "routing_" + sensor_ + "_model_path")
                 )
                 pipeline.fuse_pipeline._routing_network[sensor_].load_state_dict(
                     checkpoint["pipeline_state_dict"]
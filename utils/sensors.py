@@ -0,0 +1,70 @@
+from collections import namedtuple
+
+
+# sensor specific settings resolved once at startup
+SensorSpec = namedtuple(
+    "SensorSpec",
+    [
+        "name",
+        "resolution",  # (height, width) of the depth maps
+        "min_depth",
+        "max_depth",
+        "mask_height",  # pixels masked at the top and bottom image boundary
+        "mask_width",  # pixels masked at the left and right image boundary
+        "n_points",  # extraction band samples
+        "n_tail_points",  # samples along the ray which update the grid
+    ],
+)
+
+
+def get_setting(config, key, sensor):
+    """Method to get a sensor specific setting from a config.
+
+    Args:
+        config: config or config section, e.g. config.DATA
+        key: name of the setting with "{}" in place of the sensor suffix,
+            e.g. "n_points{}" for n_points_tof or "mask{}_height" for mask_tof_height
+        sensor: sensor name
+
+    Returns:
+        the sensor specific value, the default value when there is no sensor
+        specific value, or None when the setting does not exist
+    """
+    if config is None:
+        return None
+
+    value = getattr(config, key.format("_" + sensor), None)
+    if value is None:
+        value = getattr(config, key.format(""), None)
+
+    return value
+
+
+def get_sensor_specs(data_config, fusion_config=None):
+    """Method to resolve the settings of all input sensors.
+
+    Args:
+        data_config: DATA section of the config
+        fusion_config: FUSION_MODEL section of the config. Without it, the
+            extraction settings of the specs are None.
+
+    Returns:
+        dict mapping the sensor names to their SensorSpec
+    """
+    specs = dict()
+    for sensor in data_config.input:
+        specs[sensor] = SensorSpec(
+            name=sensor,
+            resolution=(
+                get_setting(data_config, "resy{}", sensor),
+                get_setting(data_config, "resx{}", sensor),
+            ),
+            min_depth=get_setting(data_config, "min_depth{}", sensor),
+            max_depth=get_setting(data_config, "max_depth{}", sensor),
+            mask_height=get_setting(data_config, "mask{}_height", sensor),
+            mask_width=get_setting(data_config, "mask{}_width", sensor),
+            n_points=get_setting(fusion_config, "n_points{}", sensor),
+            n_tail_points=get_setting(fusion_config, "n_tail_points{}", sensor),
+        )
+
+    return specs
@@ -15,6 +15,7 @@ import trimesh
 import skimage.measure
 
 from modules.database import Database
+from modules.voxelgrid import occupancy
 
 from utils import transform
 
@@ -135,7 +136,7 @@ class Workspace(object):
             mask = np.zeros_like(database.sensor_weighting[scene], dtype=bool)
             for sensor_ in sensors:
                 mask = np.logical_or(
-                    mask, (database.fusion_weights[sensor_][scene] > 0)
+                    mask, occupancy(database.fusion_weights[sensor_][scene])
                 )
 
             hist = database.sensor_weighting[scene][mask].flatten().astype(np.float32)
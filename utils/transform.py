@@ -11,7 +11,7 @@ class ToTensor(object):
         result = {}
 
         for key in sample.keys():
-            if type(sample[key]) is np.ndarray:
+            if isinstance(sample[key], np.ndarray):  # also memory mapped grids
 
                 if key == "image":
                     # swap color axis because